@@ -0,0 +1,190 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Measures cold starts of the verification Lambda: the time to import 'app' and the latency of the first
+# invocation of each route, in fresh Python processes. AWS calls are answered locally by botocore stubs.
+#
+# Usage:
+#   python benchmarks/cold_start.py --runs 10 --max-import-ms 500 --max-first-invocation-ms 300
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda')
+ROUTES = ['start', 'frames', 'verify']
+TOKEN_SECRET = 'cold-start-benchmark-secret-0123456789'
+CHALLENGE_ID = '00000000-0000-0000-0000-000000000000'
+FRAMES = 3
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures cold starts of the verification Lambda')
+    parser.add_argument('--runs', type=int, default=5, help='number of fresh processes per route')
+    parser.add_argument('--routes', nargs='+', choices=ROUTES, default=ROUTES)
+    parser.add_argument('--max-import-ms', type=float, help='fails if the median import time is above this value')
+    parser.add_argument('--max-first-invocation-ms', type=float,
+                        help='fails if the median first invocation latency of any route is above this value')
+    parser.add_argument('--child', choices=ROUTES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.child)))
+        return
+
+    regressions = []
+    for route in args.routes:
+        results = [run_child(route) for _ in range(args.runs)]
+        import_ms = statistics.median(result['importMs'] for result in results)
+        first_ms = statistics.median(result['firstInvocationMs'] for result in results)
+        numpy_loaded = any(result['numpyLoaded'] for result in results)
+        print('{:<7} import: {:8.1f} ms  first invocation: {:8.1f} ms  numpy loaded: {}'.format(
+            route, import_ms, first_ms, numpy_loaded))
+        if args.max_import_ms is not None and import_ms > args.max_import_ms:
+            regressions.append('{} import {:.1f} ms > {} ms'.format(route, import_ms, args.max_import_ms))
+        if args.max_first_invocation_ms is not None and first_ms > args.max_first_invocation_ms:
+            regressions.append('{} first invocation {:.1f} ms > {} ms'.format(
+                route, first_ms, args.max_first_invocation_ms))
+    if regressions:
+        print('Cold start regressions:\n  ' + '\n  '.join(regressions))
+        sys.exit(1)
+
+
+def run_child(route):
+    env = dict(os.environ)
+    env.setdefault('REGION_NAME', 'us-east-1')
+    env.setdefault('BUCKET_NAME', 'benchmark-bucket')
+    env.setdefault('DDB_TABLE', 'benchmark-table')
+    env.setdefault('TOKEN_SECRET_ARN', 'arn:aws:secretsmanager:us-east-1:123456789012:secret:benchmark')
+    env.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    env.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', route],
+                            env=env, check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def measure(route):
+    sys.path.insert(0, LAMBDA_DIR)
+    start = time.perf_counter()
+    import app
+    import_ms = (time.perf_counter() - start) * 1000
+
+    import clients
+    from jwt_token import Token
+    stubbers = []
+    stub_clients(clients, route, stubbers)
+    clients.token_secret_cache.fetch = lambda: TOKEN_SECRET
+    token = Token(CHALLENGE_ID, TOKEN_SECRET).get_jwt()
+
+    start = time.perf_counter()
+    response = app.lambda_handler(get_event(route, token), None)
+    first_ms = (time.perf_counter() - start) * 1000
+    if response['statusCode'] != 200:
+        raise RuntimeError('Unexpected response: {}'.format(response))
+    return {
+        'importMs': import_ms,
+        'firstInvocationMs': first_ms,
+        'numpyLoaded': 'numpy' in sys.modules
+    }
+
+
+# Clients are still created (and timed) by the application; their calls are answered by stubs
+def stub_clients(clients, route, stubbers):
+    from botocore.stub import Stubber
+    create_client = clients.create_client
+    create_resource = clients.create_resource
+
+    def create_stubbed_client(service_name, config=None):
+        client = create_client(service_name, config)
+        stubbers.append(activate_stubber(Stubber(client), service_name, route))
+        return client
+
+    def create_stubbed_resource(service_name):
+        resource = create_resource(service_name)
+        stubbers.append(activate_stubber(Stubber(resource.meta.client), service_name, route))
+        return resource
+
+    clients.create_client = create_stubbed_client
+    clients.create_resource = create_stubbed_resource
+
+
+def activate_stubber(stubber, service_name, route):
+    for operation, response in get_responses(route).get(service_name, []):
+        stubber.add_response(operation, response)
+    stubber.activate()
+    return stubber
+
+
+def get_responses(route):
+    if route == 'start':
+        return {'dynamodb': [('put_item', {})]}
+    if route == 'frames':
+        return {'dynamodb': [('update_item', {})], 's3': [('put_object', {})]}
+    return {
+        'dynamodb': [('get_item', {'Item': get_challenge_item()}), ('update_item', {})],
+        'rekognition': [('detect_faces', {'FaceDetails': [get_face_details()]})] * FRAMES
+    }
+
+
+def get_challenge_item():
+    frames = [{'M': {'timestamp': {'N': str(1000 + i * 100)},
+                     'key': {'S': '{}/{}.jpg'.format(CHALLENGE_ID, 1000 + i * 100)}}} for i in range(FRAMES)]
+    return {
+        'id': {'S': CHALLENGE_ID},
+        'userId': {'S': 'benchmark'},
+        'imageWidth': {'N': '640'},
+        'imageHeight': {'N': '480'},
+        'areaLeft': {'N': '185'},
+        'areaTop': {'N': '60'},
+        'areaWidth': {'N': '270'},
+        'areaHeight': {'N': '360'},
+        'minFaceAreaPercent': {'N': '50'},
+        'noseLeft': {'N': '380'},
+        'noseTop': {'N': '240'},
+        'noseWidth': {'N': '20'},
+        'noseHeight': {'N': '20'},
+        'frames': {'L': frames}
+    }
+
+
+# A face inside the area box with the nose inside the nose box, so that every state runs
+def get_face_details():
+    landmarks = [{'Type': 'eyeLeft', 'X': 0.45, 'Y': 0.4}, {'Type': 'eyeRight', 'X': 0.55, 'Y': 0.4},
+                 {'Type': 'mouthLeft', 'X': 0.47, 'Y': 0.6}, {'Type': 'mouthRight', 'X': 0.53, 'Y': 0.6},
+                 {'Type': 'nose', 'X': 390 / 640, 'Y': 250 / 480}]
+    return {
+        'BoundingBox': {'Left': 230 / 640, 'Top': 100 / 480, 'Width': 180 / 640, 'Height': 260 / 480},
+        'Landmarks': landmarks,
+        'Pose': {'Yaw': 0.0, 'Roll': 0.0, 'Pitch': 0.0}
+    }
+
+
+def get_event(route, token):
+    if route == 'start':
+        return {
+            'httpMethod': 'POST',
+            'path': '/challenge/start',
+            'pathParameters': None,
+            'body': json.dumps({'userId': 'benchmark', 'imageWidth': 640, 'imageHeight': 480})
+        }
+    if route == 'frames':
+        return {
+            'httpMethod': 'PUT',
+            'path': '/challenge/{}/frames'.format(CHALLENGE_ID),
+            'pathParameters': {'challengeId': CHALLENGE_ID},
+            'body': json.dumps({'token': token, 'timestamp': 1000, 'frameBase64': 'AAAA'})
+        }
+    return {
+        'httpMethod': 'POST',
+        'path': '/challenge/{}/verify'.format(CHALLENGE_ID),
+        'pathParameters': {'challengeId': CHALLENGE_ID},
+        'body': json.dumps({'token': token})
+    }
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Drives the verification Lambda end to end (start, one request per frame, verify) without an AWS account.
+# S3 and DynamoDB are emulated by moto and Rekognition by the local detector, fed with synthetic FaceDetails;
+# every call can be delayed to mimic the network. Reports latency and CPU time percentiles per route, for
+# each frame count and detection pool size. Each pool size runs in a fresh process, as the Lambda reads its
+# configuration on import: other settings can be given as environment variables (e.g. INCREMENTAL_VERIFICATION).
+#
+# Usage (requires moto):
+#   python benchmarks/end_to_end.py --frames 10 30 60 --pool-sizes 1 5 10 \
+#       --s3-latency-ms 20 --dynamodb-latency-ms 10 --rekognition-latency-ms 150
+
+import argparse
+import base64
+import json
+import os
+import subprocess
+import sys
+import time
+
+import synthetic
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda')
+ROUTES = ['start', 'frames', 'verify']
+TOKEN_SECRET = 'end-to-end-benchmark-secret-0123456789'
+REGION_NAME = 'us-east-1'
+BUCKET_NAME = 'benchmark-bucket'
+TABLE_NAME = 'benchmark-table'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the verification Lambda end to end with local AWS stand-ins')
+    parser.add_argument('--frames', type=int, nargs='+', default=[10, 30, 60], help='frames per session')
+    parser.add_argument('--pool-sizes', type=int, nargs='+', default=[10],
+                        help='detection pool sizes (frames of a verification analyzed at once)')
+    parser.add_argument('--sessions', type=int, default=20, help='measured sessions per frame count')
+    parser.add_argument('--warmup-sessions', type=int, default=2, help='sessions run before measuring')
+    parser.add_argument('--failing-ratio', type=float, default=0.5, help='share of sessions that fail the challenge')
+    parser.add_argument('--frame-bytes', type=int, default=20000, help='size of each uploaded frame')
+    parser.add_argument('--s3-latency-ms', type=float, default=0.0, help='delay added to each S3 call')
+    parser.add_argument('--dynamodb-latency-ms', type=float, default=0.0, help='delay added to each DynamoDB call')
+    parser.add_argument('--rekognition-latency-ms', type=float, default=0.0, help='delay added to each detection')
+    parser.add_argument('--output', help='writes the results as JSON to this file')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(json.loads(args.child))))
+        return
+
+    results = []
+    for pool_size in args.pool_sizes:
+        config = {
+            'frames': args.frames,
+            'sessions': args.sessions,
+            'warmupSessions': args.warmup_sessions,
+            'failingRatio': args.failing_ratio,
+            'frameBytes': args.frame_bytes,
+            's3LatencyMs': args.s3_latency_ms,
+            'dynamodbLatencyMs': args.dynamodb_latency_ms,
+            'rekognitionLatencyMs': args.rekognition_latency_ms
+        }
+        for result in run_child(config, pool_size):
+            result['poolSize'] = pool_size
+            results.append(result)
+
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    if any(result['wrongDecisions'] for result in results):
+        print('Some verifications did not return the expected decision')
+        sys.exit(1)
+
+
+def run_child(config, pool_size):
+    env = dict(os.environ)
+    env.setdefault('REGION_NAME', REGION_NAME)
+    env.setdefault('AWS_DEFAULT_REGION', REGION_NAME)
+    env.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    env.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    env.setdefault('TOKEN_SECRET_ARN', 'arn:aws:secretsmanager:us-east-1:123456789012:secret:benchmark')
+    # The benchmark measures the Lambda, not the account's Rekognition quota
+    env.setdefault('DETECTION_RATE_LIMIT', '100000')
+    env['BUCKET_NAME'] = BUCKET_NAME
+    env['DDB_TABLE'] = TABLE_NAME
+    env['FACE_DETECTOR'] = 'local'
+    env['DETECTION_WINDOW'] = str(pool_size)
+    env['DETECTION_MAX_CONCURRENCY'] = str(pool_size)
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', json.dumps(config)],
+                            env=env, check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def measure(config):
+    from moto import mock_aws
+    import boto3
+    mock = mock_aws()
+    mock.start()
+    boto3.client('s3', region_name=REGION_NAME).create_bucket(Bucket=BUCKET_NAME)
+    boto3.client('dynamodb', region_name=REGION_NAME).create_table(
+        TableName=TABLE_NAME,
+        KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'id', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+
+    sys.path.insert(0, LAMBDA_DIR)
+    import app
+    import clients
+    add_latency(clients, {'s3': config['s3LatencyMs'], 'dynamodb': config['dynamodbLatencyMs']})
+    clients.token_secret_cache.fetch = lambda: TOKEN_SECRET
+    detector = app.face_detector.detector
+    detector.latency = config['rekognitionLatencyMs'] / 1000
+
+    results = []
+    session_index = 0
+    for frame_count in config['frames']:
+        samples = {route: {'latencyMs': [], 'cpuMs': []} for route in ROUTES}
+        wrong_decisions = 0
+        for run in range(config['warmupSessions'] + config['sessions']):
+            session_index += 1
+            # Spreads the failing sessions evenly
+            passing = (session_index * config['failingRatio']) % 1 >= config['failingRatio']
+            session_samples = {route: {'latencyMs': [], 'cpuMs': []} for route in ROUTES}
+            success = run_session(app, detector, frame_count, passing, config['frameBytes'], session_index,
+                                  session_samples)
+            if run < config['warmupSessions']:
+                continue
+            wrong_decisions += success != passing
+            for route in ROUTES:
+                for name in ('latencyMs', 'cpuMs'):
+                    samples[route][name].extend(session_samples[route][name])
+        for route in ROUTES:
+            results.append({
+                'route': route,
+                'frames': frame_count,
+                'requests': len(samples[route]['latencyMs']),
+                'latencyP50Ms': get_percentile(samples[route]['latencyMs'], 50),
+                'latencyP99Ms': get_percentile(samples[route]['latencyMs'], 99),
+                'cpuP50Ms': get_percentile(samples[route]['cpuMs'], 50),
+                'cpuP99Ms': get_percentile(samples[route]['cpuMs'], 99),
+                'wrongDecisions': wrong_decisions if route == 'verify' else 0
+            })
+    # Results written behind must reach moto, not AWS
+    app.result_write_pool.shutdown(wait=True)
+    mock.stop()
+    return results
+
+
+# Delays every call of the application's clients, before moto answers it
+def add_latency(clients, latencies_ms):
+    create_client = clients.create_client
+    create_resource = clients.create_resource
+
+    def create_delayed_client(service_name, config=None):
+        client = create_client(service_name, config)
+        register_latency(client, latencies_ms.get(service_name))
+        return client
+
+    def create_delayed_resource(service_name):
+        resource = create_resource(service_name)
+        register_latency(resource.meta.client, latencies_ms.get(service_name))
+        return resource
+
+    clients.create_client = create_delayed_client
+    clients.create_resource = create_delayed_resource
+
+
+def register_latency(client, latency_ms):
+    if latency_ms:
+        client.meta.events.register_first('before-send', lambda **_: time.sleep(latency_ms / 1000))
+
+
+# Returns the decision of the verification
+def run_session(app, detector, frame_count, passing, frame_bytes, seed, samples):
+    body = json.dumps({'userId': 'benchmark', 'imageWidth': 640, 'imageHeight': 480})
+    response = call(app, samples['start'], 'POST', '/challenge/start', None, body)
+    challenge = json.loads(response['body'])
+    challenge_id = challenge['id']
+    session = synthetic.generate_session(challenge, frame_count, passing, seed=seed)
+    for timestamp, face_details in session:
+        detector.results['{}/{}.jpg'.format(challenge_id, timestamp)] = face_details
+    for timestamp, _ in session:
+        # Frames must differ, as detections are cached by frame content
+        frame = os.urandom(frame_bytes)
+        body = json.dumps({'token': challenge['token'], 'timestamp': timestamp,
+                           'frameBase64': base64.b64encode(frame).decode()})
+        call(app, samples['frames'], 'PUT', '/challenge/{}/frames'.format(challenge_id),
+             {'challengeId': challenge_id}, body)
+    body = json.dumps({'token': challenge['token']})
+    response = call(app, samples['verify'], 'POST', '/challenge/{}/verify'.format(challenge_id),
+                    {'challengeId': challenge_id}, body)
+    return json.loads(response['body'])['success']
+
+
+def call(app, samples, method, path, path_parameters, body):
+    event = {'httpMethod': method, 'path': path, 'pathParameters': path_parameters, 'body': body}
+    start = time.perf_counter()
+    start_cpu = time.process_time()
+    response = app.lambda_handler(event, None)
+    samples['cpuMs'].append((time.process_time() - start_cpu) * 1000)
+    samples['latencyMs'].append((time.perf_counter() - start) * 1000)
+    if response['statusCode'] != 200:
+        raise RuntimeError('Unexpected response: {}'.format(response))
+    return response
+
+
+# Nearest-rank percentile
+def get_percentile(values, percentile):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, -(-len(ordered) * percentile // 100) - 1)
+    return ordered[int(index)]
+
+
+def print_results(results):
+    print('{:<7} {:>6} {:>5} {:>9} {:>12} {:>12} {:>12} {:>12}'.format(
+        'route', 'frames', 'pool', 'requests', 'p50 ms', 'p99 ms', 'cpu p50 ms', 'cpu p99 ms'))
+    for result in results:
+        print('{:<7} {:>6} {:>5} {:>9} {:>12.1f} {:>12.1f} {:>12.1f} {:>12.1f}'.format(
+            result['route'], result['frames'], result['poolSize'], result['requests'], result['latencyP50Ms'],
+            result['latencyP99Ms'], result['cpuP50Ms'], result['cpuP99Ms']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Measures the CPU time spent downscaling and re-encoding frames (FRAME_MAX_SHORT_SIDE and FRAME_JPEG_QUALITY)
+# against the bytes saved, for each input resolution. Frames are synthetic camera-like JPEGs, unless real
+# frames are given with --images (each one is measured at its own resolution).
+#
+# Usage (requires Pillow):
+#   python benchmarks/frame_preprocessing.py --resolutions 640x480 1280x720 1920x1080 \
+#       --short-sides 240 360 480 --qualities 70 85
+
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import time
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda')
+# Quality of the JPEGs produced by the client (canvas.toDataURL default)
+CLIENT_QUALITY = 92
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the CPU cost and the bytes saved by frame preprocessing')
+    parser.add_argument('--resolutions', nargs='+', default=['640x480', '1280x720', '1920x1080'],
+                        help='sizes (WIDTHxHEIGHT) of the synthetic frames')
+    parser.add_argument('--images', nargs='+', help='JPEG files to use instead of synthetic frames')
+    parser.add_argument('--short-sides', type=int, nargs='+', default=[240, 360, 480])
+    parser.add_argument('--qualities', type=int, nargs='+', default=[70, 85])
+    parser.add_argument('--frames', type=int, default=20, help='synthetic frames per resolution')
+    parser.add_argument('--output', help='writes the results as JSON to this file')
+    args = parser.parse_args()
+
+    sys.path.insert(0, LAMBDA_DIR)
+    from preprocessing import FramePreprocessor
+
+    inputs = read_images(args.images) if args.images else generate_frames(args.resolutions, args.frames)
+    results = []
+    for resolution, frames in inputs.items():
+        for short_side in args.short_sides:
+            for quality in args.qualities:
+                result = measure(FramePreprocessor(short_side, quality), frames)
+                result.update({'resolution': resolution, 'shortSide': short_side, 'quality': quality})
+                results.append(result)
+
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+def measure(preprocessor, frames):
+    cpu_ms = []
+    bytes_in = 0
+    bytes_out = 0
+    for frame in frames:
+        start_cpu = time.process_time()
+        processed = preprocessor.process(frame)
+        cpu_ms.append((time.process_time() - start_cpu) * 1000)
+        bytes_in += len(frame)
+        bytes_out += len(processed)
+    cpu_ms.sort()
+    return {
+        'frames': len(frames),
+        'cpuP50Ms': cpu_ms[len(cpu_ms) // 2],
+        'cpuMaxMs': cpu_ms[-1],
+        'bytesIn': bytes_in // len(frames),
+        'bytesOut': bytes_out // len(frames),
+        'bytesRatio': bytes_out / bytes_in
+    }
+
+
+def read_images(paths):
+    from PIL import Image
+    inputs = {}
+    for path in paths:
+        with open(path, 'rb') as image_file:
+            frame = image_file.read()
+        resolution = '{}x{}'.format(*Image.open(path).size)
+        inputs.setdefault(resolution, []).append(frame)
+    return inputs
+
+
+def generate_frames(resolutions, frame_count):
+    inputs = {}
+    for resolution in resolutions:
+        width, height = (int(value) for value in resolution.split('x'))
+        inputs[resolution] = [generate_frame(width, height, seed) for seed in range(frame_count)]
+    return inputs
+
+
+# A face-like ellipse on a gradient background, with sensor noise (which makes frames as hard to compress
+# as camera frames)
+def generate_frame(width, height, seed):
+    from PIL import Image, ImageChops, ImageDraw
+    rng = random.Random(seed)
+    background = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    draw = ImageDraw.Draw(background)
+    center_x = width * rng.uniform(0.4, 0.6)
+    center_y = height * rng.uniform(0.4, 0.6)
+    face_w = min(width, height) * 0.35
+    face_h = face_w * 1.3
+    draw.ellipse([center_x - face_w / 2, center_y - face_h / 2, center_x + face_w / 2, center_y + face_h / 2],
+                 fill=(rng.randint(150, 230), rng.randint(110, 180), rng.randint(90, 150)))
+    for eye_x in (center_x - face_w / 5, center_x + face_w / 5):
+        draw.ellipse([eye_x - face_w / 14, center_y - face_h / 6, eye_x + face_w / 14, center_y - face_h / 10],
+                     fill=(40, 30, 30))
+    noise = Image.effect_noise((width, height), 12).convert('RGB')
+    image = ImageChops.add(background, noise, scale=1.0, offset=-128)
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=CLIENT_QUALITY)
+    return output.getvalue()
+
+
+def print_results(results):
+    print('{:<10} {:>10} {:>8} {:>12} {:>12} {:>10} {:>10} {:>7}'.format(
+        'resolution', 'short side', 'quality', 'cpu p50 ms', 'cpu max ms', 'bytes in', 'bytes out', 'ratio'))
+    for result in results:
+        print('{:<10} {:>10} {:>8} {:>12.2f} {:>12.2f} {:>10} {:>10} {:>7.2f}'.format(
+            result['resolution'], result['shortSide'], result['quality'], result['cpuP50Ms'], result['cpuMaxMs'],
+            result['bytesIn'], result['bytesOut'], result['bytesRatio']))
+
+
+if __name__ == '__main__':
+    main()
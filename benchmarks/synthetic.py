@@ -0,0 +1,90 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Generates Rekognition FaceDetails for synthetic challenge sessions: a few frames without a face, a face that
+# comes closer until it fills the area, and a nose that moves in a straight line to the nose box while the
+# face rotates. Failing sessions move the nose in a zigzag, so the trajectory check rejects them.
+
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+from face_metadata import LANDMARK_TYPES  # noqa: E402
+
+FRAMES_WITHOUT_FACE = 3
+MAX_NOSE_FRAMES = 60
+FACE_WIDTH_RATIO = 0.6
+FACE_HEIGHT_RATIO = 0.7
+MIN_FACE_SCALE = 0.5
+MAX_YAW = 20.0
+MAX_SQUASH = 1.5
+ZIGZAG_OFFSET = 0.05
+LANDMARK_COLUMNS = 5
+
+
+# Returns a list of (timestamp, face details) pairs
+def generate_session(challenge, frame_count, passing=True, start_timestamp=1600000000000, frame_interval_ms=83,
+                     seed=None):
+    rng = random.Random(seed)
+    width = challenge['imageWidth']
+    height = challenge['imageHeight']
+    face_width = challenge['areaWidth'] * FACE_WIDTH_RATIO / width
+    face_height = challenge['areaHeight'] * FACE_HEIGHT_RATIO / height
+    center_x = (challenge['areaLeft'] + challenge['areaWidth'] / 2) / width
+    center_y = (challenge['areaTop'] + challenge['areaHeight'] / 2) / height
+    target_x = (challenge['noseLeft'] + challenge['noseWidth'] / 2) / width
+    target_y = (challenge['noseTop'] + challenge['noseHeight'] / 2) / height
+    rotation = 1 if target_x > 0.5 else -1
+
+    without_face = min(FRAMES_WITHOUT_FACE, frame_count // 4)
+    nose_frames = min(MAX_NOSE_FRAMES, (frame_count - without_face) // 2)
+    approach_frames = frame_count - without_face - nose_frames
+    session = []
+    for index in range(frame_count):
+        timestamp = start_timestamp + index * frame_interval_ms
+        if index < without_face:
+            session.append((timestamp, []))
+            continue
+        if index < without_face + approach_frames:
+            # The face comes closer, centered on the area, until it is big enough
+            progress = (index - without_face + 1) / approach_frames
+            scale = MIN_FACE_SCALE + (1 - MIN_FACE_SCALE) * progress
+            face = get_face(center_x, center_y, face_width * scale, face_height * scale, center_x, center_y, 0, 0)
+        else:
+            progress = (index - without_face - approach_frames + 1) / nose_frames
+            nose_x = center_x + (target_x - center_x) * progress
+            nose_y = center_y + (target_y - center_y) * progress
+            if not passing and index % 2:
+                nose_y += ZIGZAG_OFFSET
+            face = get_face(center_x, center_y, face_width, face_height, nose_x, nose_y,
+                            rotation * MAX_YAW * progress, MAX_SQUASH * progress)
+        face['Confidence'] = 99.0 + rng.random()
+        session.append((timestamp, [face]))
+    return session
+
+
+# Landmarks are spread over the face on a grid, squashed towards one side as the face rotates
+def get_face(center_x, center_y, face_width, face_height, nose_x, nose_y, yaw, squash):
+    landmarks = []
+    rows = (len(LANDMARK_TYPES) + LANDMARK_COLUMNS - 1) // LANDMARK_COLUMNS
+    for index, landmark_type in enumerate(LANDMARK_TYPES):
+        if landmark_type == 'nose':
+            x, y = nose_x, nose_y
+        else:
+            column = (index % LANDMARK_COLUMNS) / (LANDMARK_COLUMNS - 1)
+            row = (index // LANDMARK_COLUMNS) / rows
+            x = center_x - face_width / 2 + column ** (1 + squash) * face_width
+            y = center_y - face_height / 2 + row * face_height
+        landmarks.append({'Type': landmark_type, 'X': x, 'Y': y})
+    return {
+        'BoundingBox': {
+            'Left': center_x - face_width / 2,
+            'Top': center_y - face_height / 2,
+            'Width': face_width,
+            'Height': face_height
+        },
+        'Landmarks': landmarks,
+        'Pose': {'Yaw': yaw, 'Roll': 0.0, 'Pitch': 0.0}
+    }
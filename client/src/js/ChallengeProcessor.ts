@@ -167,6 +167,10 @@ export class ChallengeProcessor {
 
       // if successfully completed locally, pass along remoteVerifier to callback for remote verification
       challengeProcessor.endCallback(localSuccess, localSuccess ? challengeProcessor.remoteVerifier : undefined);
+    } else if (challengeProcessor.remoteVerifier.isUploadComplete()) {
+      // the server already reached a decision, which remote verification returns
+      Logger.info("challenge completed remotely");
+      challengeProcessor.endCallback(true, challengeProcessor.remoteVerifier);
     } else {
       const delay = 1000 / parseInt(Utils.getConfig().MAX_FPS);
       setTimeout(() => ChallengeProcessor.process(challengeProcessor), delay);
@@ -11,8 +11,18 @@ interface FramesRequestData {
   readonly token: string;
 }
 
+// Besides the message, the server may suggest an interval between uploads and, when it analyzes frames on arrival,
+// report its state and that further frames can no longer change the decision
 interface FramesResponseData {
   readonly message: string;
+  readonly uploadIntervalMs?: number;
+  readonly state?: string;
+  readonly stopUploading?: boolean;
+}
+
+interface BatchFrame {
+  readonly timestamp: number;
+  readonly blob: Blob;
 }
 
 interface VerifyRequestData {
@@ -29,12 +39,25 @@ export class RemoteVerifier {
   private readonly videoElement: HTMLVideoElement;
   private readonly promises: Promise<any>[];
   private readonly invisibleCanvas: HTMLCanvasElement;
+  private readonly batchSize: number;
+  private readonly batchFrames: BatchFrame[];
+  private readonly batchPromises: Promise<any>[];
+
+  private uploadIntervalMs: number;
+  private lastUploadTime: number;
+  private uploadComplete: boolean;
 
   constructor(challengeId: string, token: string, videoElement: HTMLVideoElement) {
     this.challengeId = challengeId;
     this.token = token;
     this.videoElement = videoElement;
     this.promises = [];
+    this.batchSize = parseInt(Utils.getConfig().FRAMES_BATCH_SIZE) || 1;
+    this.batchFrames = [];
+    this.batchPromises = [];
+    this.uploadIntervalMs = 0;
+    this.lastUploadTime = 0;
+    this.uploadComplete = false;
 
     // Create canvas to convert video frames to blob
     this.invisibleCanvas = document.createElement("canvas");
@@ -42,7 +65,21 @@ export class RemoteVerifier {
     this.invisibleCanvas.height = this.videoElement.height;
   }
 
+  // Whether the server has already reached a decision
+  isUploadComplete(): boolean {
+    return this.uploadComplete;
+  }
+
   uploadFrame() {
+    if (this.uploadComplete) {
+      Logger.debug("frame not uploaded: decision already reached");
+      return;
+    }
+    if (Date.now() - this.lastUploadTime < this.uploadIntervalMs) {
+      Logger.debug("frame not uploaded: suggested interval not elapsed");
+      return;
+    }
+    this.lastUploadTime = Date.now();
     const context = this.invisibleCanvas.getContext("2d");
     if (context === null) {
       throw "Error getting canvas context";
@@ -61,8 +98,13 @@ export class RemoteVerifier {
           function(blob) {
             if (blob === null) {
               reject(new Error("Error creating blob from canvas"));
+            } else if (self.batchSize > 1) {
+              self.addToBatch({ timestamp: Date.now(), blob: blob });
+              resolve();
             } else {
-              RemoteVerifier.callFramesApi(self.challengeId, self.token, blob, resolve, reject);
+              RemoteVerifier.callFramesApi(self.challengeId, self.token, blob, resolve, reject, function(data) {
+                self.applyHints(data);
+              });
             }
           },
           "image/jpeg",
@@ -77,7 +119,8 @@ export class RemoteVerifier {
     token: string,
     blob: Blob,
     resolve: () => void,
-    reject: (error: Error) => void
+    reject: (error: Error) => void,
+    hintsCallback: (data: FramesResponseData) => void
   ) {
     Logger.info("uploading frame");
     const reader: FileReader = new FileReader();
@@ -104,6 +147,7 @@ export class RemoteVerifier {
           const verifyResponseData: FramesResponseData = response.data;
           Logger.info(verifyResponseData);
           Logger.info("frame successfully uploaded");
+          hintsCallback(verifyResponseData);
           resolve();
         })
         .catch(function(error: any) {
@@ -113,16 +157,101 @@ export class RemoteVerifier {
     };
   }
 
+  private applyHints(data: FramesResponseData) {
+    if (data.uploadIntervalMs !== undefined) {
+      this.uploadIntervalMs = data.uploadIntervalMs;
+    }
+    if (data.state !== undefined) {
+      Logger.info(`server state: ${data.state}`);
+    }
+    if (data.stopUploading) {
+      Logger.info("server reached a decision: no more frames will be uploaded");
+      this.uploadComplete = true;
+      // Frames waiting for a batch can no longer change the decision
+      this.batchFrames.splice(0, this.batchFrames.length);
+    }
+  }
+
+  private addToBatch(batchFrame: BatchFrame) {
+    this.batchFrames.push(batchFrame);
+    if (this.batchFrames.length >= this.batchSize) {
+      this.flushBatch();
+    }
+  }
+
+  private flushBatch() {
+    if (this.batchFrames.length > 0) {
+      const batchFrames = this.batchFrames.splice(0, this.batchFrames.length);
+      const self = this;
+      this.batchPromises.push(
+        RemoteVerifier.callFramesBatchApi(this.challengeId, this.token, batchFrames, function(data) {
+          self.applyHints(data);
+        })
+      );
+    }
+  }
+
+  // Sends several frames in a single request. Each frame is encoded as: timestamp (8 bytes), size (4 bytes) and
+  // JPEG bytes (integers are unsigned and big-endian)
+  static callFramesBatchApi(
+    challengeId: string,
+    token: string,
+    batchFrames: BatchFrame[],
+    hintsCallback: (data: FramesResponseData) => void
+  ): Promise<any> {
+    Logger.info(`uploading ${batchFrames.length} frames`);
+    const parts: BlobPart[] = [];
+    batchFrames.forEach(function(batchFrame) {
+      const header = new DataView(new ArrayBuffer(12));
+      header.setUint32(0, Math.floor(batchFrame.timestamp / 2 ** 32));
+      header.setUint32(4, batchFrame.timestamp % 2 ** 32);
+      header.setUint32(8, batchFrame.blob.size);
+      parts.push(header.buffer, batchFrame.blob);
+    });
+    const framesBatchEndpoint: string = Utils.getConfig().API_FRAMES_BATCH_ENDPOINT_PATTERN.replace(
+      "{challengeId}",
+      challengeId
+    );
+    const url: string = Utils.getConfig().API_URL + framesBatchEndpoint;
+
+    Logger.info(`calling ${url}`);
+    const promise = axios.put(url, new Blob(parts), {
+      headers: {
+        "Content-Type": "application/octet-stream",
+        Authorization: `Bearer ${token}`
+      }
+    });
+    return promise
+      .then(function(response: any) {
+        Logger.info(response);
+        Logger.info("frames successfully uploaded");
+        hintsCallback(response.data);
+      })
+      .catch(function(error: any) {
+        Logger.error(error);
+        throw error;
+      });
+  }
+
   verify(successCallback: (result: boolean) => void, errorCallback: (error: Error) => void): void {
     Logger.debug(this.promises);
     const self = this;
-    Promise.all(this.promises).then(function() {
-      Logger.info("all frames uploaded");
-      const requestData: VerifyRequestData = {
-        token: self.token
-      };
-      self.callVerificationApi(requestData, successCallback, errorCallback);
-    });
+    Promise.all(this.promises)
+      .then(function() {
+        self.flushBatch();
+        return Promise.all(self.batchPromises);
+      })
+      .then(function() {
+        Logger.info("all frames uploaded");
+        const requestData: VerifyRequestData = {
+          token: self.token
+        };
+        self.callVerificationApi(requestData, successCallback, errorCallback);
+      })
+      .catch(function(error: any) {
+        Logger.error(error);
+        errorCallback(error);
+      });
   }
 
   private callVerificationApi(
@@ -11,9 +11,11 @@ export interface Config {
   API_START_ENDPOINT: string;
   API_VERIFY_ENDPOINT_PATTERN: string;
   API_FRAMES_ENDPOINT_PATTERN: string;
+  API_FRAMES_BATCH_ENDPOINT_PATTERN: string;
   IMAGE_WIDTH: string;
   IMAGE_HEIGHT: string;
   IMAGE_JPG_QUALITY: string;
+  FRAMES_BATCH_SIZE: string;
   STATE_AREA_DURATION_IN_SECONDS: string;
   STATE_NOSE_DURATION_IN_SECONDS: string;
   STATE_AREA_MAX_FRAMES_WITHOUT_FACE: string;
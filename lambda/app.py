@@ -2,54 +2,118 @@
 # SPDX-License-Identifier: MIT-0
 
 import base64
-import decimal
+import hashlib
 import json
+import logging
 import os
+import random
 import re
+import struct
+import time
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
-import boto3
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing
 
 from botocore.exceptions import ClientError
-from aws_lambda_powertools.utilities import parameters
 
 from challenge import Challenge
+from challenge_cache import ChallengeCache
 from states.manager import StateManager
 from states.face import FaceState
 from jwt_token import Token
+from clients import get_detection_cache_table, get_dynamodb, get_rekognition, get_s3, get_table, get_token_secret
+from detection import RateControlledDetector, create_detector
+from detection_cache import DetectionCache
+from face_metadata import PROFILES
+from instrumentation import (InstrumentedStateEngine, InstrumentedStateManager, increment, instrument_request, span,
+                             timed)
+from items import read_item, write_item
+from observation import FaceObservation
+from preprocessing import FramePreprocessor
 
 
-region_name = os.getenv('REGION_NAME')
 bucket_name = os.getenv('BUCKET_NAME')
-dynamo_table = os.getenv('DDB_TABLE')
-token_secret_arn = os.getenv('TOKEN_SECRET_ARN')
+incremental_verification = os.getenv('INCREMENTAL_VERIFICATION', 'false').lower() == 'true'
+# Stateless challenges carry their parameters in the token: start does not write them to the
+# DynamoDB table (they are written along with the first frames) and verify does not read them back
+stateless_challenges = os.getenv('STATELESS_CHALLENGES', 'false').lower() == 'true'
+token_ttl_seconds = int(os.getenv('TOKEN_TTL_SECONDS', '600'))
+# With 's3', Rekognition reads frames back from the bucket; with 'bytes', frames are analyzed as soon as they are received
+detection_source = os.getenv('DETECTION_SOURCE', 's3')
+# Only applies to the 'bytes' detection source: 'sync', 'deferred', 'sampled' or 'none'
+frame_archive_mode = os.getenv('FRAME_ARCHIVE_MODE', 'sync')
+frame_archive_sample_rate = float(os.getenv('FRAME_ARCHIVE_SAMPLE_RATE', '0.1'))
+# With 's3', frame uploads only write to the bucket and verification lists the frames from it; with 'item', they
+# are also appended to the challenge item. Only applies when frames are analyzed at verification (DETECTION_SOURCE
+# 's3' without INCREMENTAL_VERIFICATION), as the other modes store detection results along with the frames.
+frame_index = os.getenv('FRAME_INDEX', 'item')
+list_frames_from_s3 = frame_index == 's3' and detection_source == 's3' and not incremental_verification
+# Interval between frame uploads suggested to clients (0 to leave it to them)
+frame_upload_interval_ms = int(os.getenv('FRAME_UPLOAD_INTERVAL_MS', '0'))
+# 'classes' (states package) or 'table' (states.engine, same decisions without allocating states)
+state_engine = os.getenv('STATE_ENGINE', 'classes')
+# Frames with a larger short side are downscaled to it (and re-encoded) before being stored and analyzed
+frame_preprocessor = FramePreprocessor(int(os.getenv('FRAME_MAX_SHORT_SIDE', '0')),
+                                       int(os.getenv('FRAME_JPEG_QUALITY', '85')))
+face_metadata_profile = PROFILES[os.getenv('FACE_METADATA_PROFILE', 'full')]
+detection_cache = DetectionCache(
+    int(os.getenv('DETECTION_CACHE_SIZE', '1024')),
+    get_detection_cache_table if os.getenv('DETECTION_CACHE_TABLE') else None,
+    int(os.getenv('DETECTION_CACHE_TTL_SECONDS', '86400'))
+)
+face_detector = RateControlledDetector(
+    create_detector(os.getenv('FACE_DETECTOR', 'rekognition'), get_rekognition, bucket_name),
+    rate=float(os.getenv('DETECTION_RATE_LIMIT', '50')),
+    min_concurrency=int(os.getenv('DETECTION_MIN_CONCURRENCY', '1')),
+    max_concurrency=int(os.getenv('DETECTION_MAX_CONCURRENCY', '20')),
+    max_attempts=int(os.getenv('DETECTION_MAX_ATTEMPTS', '5'))
+)
+# Frames of a single verification in flight at once
+detection_window = int(os.getenv('DETECTION_WINDOW', '10'))
+# Shared by all requests of the container (the detector bounds the calls actually in flight)
+detection_pool = ThreadPoolExecutor(max_workers=face_detector.limiter.max_limit)
+archive_pool = ThreadPoolExecutor(max_workers=int(os.getenv('FRAME_ARCHIVE_MAX_WORKERS', '10')))
+# Frames of batch uploads stored (and, with incremental verification, analyzed) at once, across requests
+upload_pool = ThreadPoolExecutor(max_workers=int(os.getenv('FRAME_UPLOAD_MAX_WORKERS', '10')))
+# Challenges of a bulk verification evaluated at once (their frames share the detection pool)
+bulk_verification_pool = ThreadPoolExecutor(max_workers=int(os.getenv('BULK_VERIFICATION_CONCURRENCY', '4')))
+# Parameters of the challenges started or read by the container (0 to always read them from the table)
+challenge_cache = ChallengeCache(int(os.getenv('CHALLENGE_CACHE_SIZE', '1024')),
+                                 int(os.getenv('CHALLENGE_CACHE_TTL_SECONDS', '600')))
+# With 'behind', the decision is returned without waiting for it (and the frames analyzed) to be written
+result_write_mode = os.getenv('RESULT_WRITE_MODE', 'sync')
+# Pending writes complete when the process exits (but not when a Lambda container is shut down)
+result_write_pool = ThreadPoolExecutor(max_workers=int(os.getenv('RESULT_WRITE_MAX_WORKERS', '4')))
+
+# Share of requests profiled, besides the ones asking for it with the 'X-Profile' header (when allowed)
+profiling_sample_rate = float(os.getenv('PROFILING_SAMPLE_RATE', '0'))
+profiling_header_enabled = os.getenv('PROFILING_HEADER_ENABLED', 'false').lower() == 'true'
 
-token_secret = parameters.get_secret(token_secret_arn)
-s3 = boto3.client('s3', region_name=region_name)
-rek = boto3.client('rekognition', region_name=region_name)
-ddb = boto3.resource('dynamodb', region_name=region_name)
-table = ddb.Table(dynamo_table)
+logger = logging.getLogger()
+logger.setLevel(os.getenv('LOG_LEVEL', 'INFO'))
 
 START_PATTERN = re.compile('/challenge/start')
+PUT_FRAMES_BATCH_PATTERN = re.compile('\\/challenge\\/[A-Za-z0-9-]*\\/frames\\/batch')
 PUT_FRAME_PATTERN = re.compile('\\/challenge\\/[A-Za-z0-9-]*\\/frames')
 VERIFY_PATTERN = re.compile('\\/challenge\\/[A-Za-z0-9-]*\\/verify')
+VERIFY_BATCH_PATTERN = re.compile('\\/challenge\\/verify\\/batch')
 
+MAX_FRAMES_PER_BATCH = 50
+# Keys accepted by a single BatchGetItem request
+MAX_CHALLENGES_PER_BATCH = 100
+BATCH_GET_MAX_ATTEMPTS = 5
+BATCH_GET_BASE_DELAY_SECONDS = 0.05
+FRAME_HEADER = struct.Struct('>QI')
+FRAME_KEY_PATTERN = re.compile('[A-Za-z0-9-]+\\/([0-9]+)\\.jpg$')
+# Attributes read back by incremental verification instead of the frames
+PROGRESS_ATTRIBUTES = ('id', 'stateSnapshot', 'frameTimestamps')
 
-def lambda_handler(event, _):
-    method = event['httpMethod']
-    path = event['path']
 
-    body = json.loads(event['body'])
-    if method == 'POST' and START_PATTERN.match(path):
-        status_code, response = start_challenge(body)
-    elif method == 'PUT' and PUT_FRAME_PATTERN.match(path):
-        challenge_id = get_challenge_id(event)
-        status_code, response = execute_if_token_is_valid(body['token'], challenge_id, put_challenge_frame,
-                                                          challenge_id, body)
-    elif method == 'POST' and VERIFY_PATTERN.match(path):
-        challenge_id = get_challenge_id(event)
-        status_code, response = execute_if_token_is_valid(body['token'], challenge_id, verify_challenge, challenge_id)
+def lambda_handler(event, _):
+    route = get_route(event)
+    with instrument_request(route, is_profiling_requested(event)):
+        status_code, response = handle_request(route, event)
 
     return {
         'statusCode': status_code,
@@ -62,133 +126,787 @@ def lambda_handler(event, _):
     }
 
 
-# Executes the 'func' function, with the 'args' arguments, if the JWT is valid
+def get_route(event):
+    method = event['httpMethod']
+    path = event['path']
+    if method == 'PUT' and PUT_FRAMES_BATCH_PATTERN.match(path):
+        return 'framesBatch'
+    if method == 'POST' and VERIFY_BATCH_PATTERN.match(path):
+        return 'verifyBatch'
+    if method == 'POST' and START_PATTERN.match(path):
+        return 'start'
+    if method == 'PUT' and PUT_FRAME_PATTERN.match(path):
+        return 'frames'
+    if method == 'POST' and VERIFY_PATTERN.match(path):
+        return 'verify'
+    return None
+
+
+def handle_request(route, event):
+    if route is None:
+        return 404, {'message': 'Route not found'}
+    if route == 'framesBatch':
+        challenge_id = get_challenge_id(event)
+        return execute_if_token_is_valid(get_bearer_token(event), challenge_id, put_challenge_frames_batch,
+                                         challenge_id, get_binary_body(event))
+    with span('ParseBody'):
+        body = json.loads(event['body'])
+    if route == 'start':
+        return start_challenge(body)
+    if route == 'verifyBatch':
+        return verify_challenges(body)
+    if route == 'frames':
+        challenge_id = get_challenge_id(event)
+        return execute_if_token_is_valid(body['token'], challenge_id, put_challenge_frame, challenge_id, body)
+    challenge_id = get_challenge_id(event)
+    return execute_if_token_is_valid(body['token'], challenge_id, verify_challenge, challenge_id)
+
+
+def is_profiling_requested(event):
+    if profiling_header_enabled:
+        headers = {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+        if headers.get('x-profile', '').lower() == 'true':
+            return True
+    return random.random() < profiling_sample_rate
+
+
+# Executes the 'func' function, with the 'args' arguments and the challenge carried by the token
+# (None unless the challenge is stateless), if the JWT is valid
 def execute_if_token_is_valid(token, challenge_id, func, *args):
-    if Token(challenge_id, token_secret).verify_jwt(token):
-        return func(*args)
-    return 403, {'message': 'Invalid token'}
+    with span('VerifyToken'):
+        claims = Token(challenge_id, get_token_secret()).get_claims(token)
+    if claims is None:
+        return 403, {'message': 'Invalid token'}
+    return func(*args, Challenge.from_claims(challenge_id, claims))
 
 
 def get_challenge_id(event):
     return event['pathParameters'].get('challengeId', None) if event['pathParameters'] else None
 
 
+# Binary requests carry the token in the 'Authorization: Bearer <token>' header
+def get_bearer_token(event):
+    headers = {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+    authorization = headers.get('authorization', '')
+    return authorization[len('Bearer '):] if authorization.startswith('Bearer ') else None
+
+
+def get_binary_body(event):
+    body = event['body'] or ''
+    if event.get('isBase64Encoded'):
+        return base64.b64decode(body)
+    return body.encode('latin-1')
+
+
 def start_challenge(request):
     user_id = request['userId']
     image_width = int(request['imageWidth'])
     image_height = int(request['imageHeight'])
-    challenge = vars(Challenge(user_id, image_width, image_height, token_secret))
-    table.put_item(Item=challenge)
+    challenge = vars(Challenge(user_id, image_width, image_height, get_token_secret(), stateless_challenges,
+                               token_ttl_seconds if stateless_challenges else None))
+    if not stateless_challenges:
+        with span('PutItem'):
+            get_table().put_item(Item=challenge)
+        challenge_cache.put(challenge['id'], challenge)
     return 200, challenge
 
 
-def put_challenge_frame(challenge_id, request):
+def put_challenge_frame(challenge_id, request, token_challenge):
     timestamp = int(request['timestamp'])
-    frame = base64.b64decode(request['frameBase64'])
-    frame_key = '{}/{}.jpg'.format(challenge_id, timestamp)
-    # Updating challenge on DynamoDB table
+    with span('DecodeFrame'):
+        frame = base64.b64decode(request['frameBase64'])
+    return put_challenge_frames(challenge_id, [(timestamp, frame)], 'Frame saved successfully', token_challenge)
+
+
+def put_challenge_frames_batch(challenge_id, body, token_challenge):
+    try:
+        with span('DecodeFrame'):
+            frames = parse_frames_batch(body)
+    except ValueError as error:
+        return 400, {'message': str(error)}
+    return put_challenge_frames(challenge_id, frames, 'Frames saved successfully', token_challenge)
+
+
+# Parses a batch of frames, each one encoded as: timestamp (8 bytes), size (4 bytes) and JPEG bytes.
+# All integers are unsigned and big-endian.
+def parse_frames_batch(body):
+    frames = []
+    offset = 0
+    while offset < len(body):
+        if offset + FRAME_HEADER.size > len(body):
+            raise ValueError('Truncated frame header')
+        timestamp, size = FRAME_HEADER.unpack_from(body, offset)
+        offset += FRAME_HEADER.size
+        if offset + size > len(body):
+            raise ValueError('Truncated frame')
+        frames.append((timestamp, body[offset:offset + size]))
+        offset += size
+    if not frames:
+        raise ValueError('No frames')
+    if len(frames) > MAX_FRAMES_PER_BATCH:
+        raise ValueError('Too many frames (maximum is {})'.format(MAX_FRAMES_PER_BATCH))
+    return frames
+
+
+def put_challenge_frames(challenge_id, frames, message, token_challenge):
+    increment('FramesReceived', len(frames))
+    if frame_preprocessor.is_enabled():
+        increment('FrameBytesReceived', sum(len(frame) for _, frame in frames))
+        with span('PreprocessFrame'):
+            frames = [(timestamp, frame_preprocessor.process(frame)) for timestamp, frame in frames]
+        increment('FrameBytesStored', sum(len(frame) for _, frame in frames))
+    with span('HashFrame'):
+        frame_items = [FaceObservation(timestamp, '{}/{}.jpg'.format(challenge_id, timestamp),
+                                       content_hash=hashlib.sha256(frame).hexdigest()) for timestamp, frame in frames]
+    if detection_source == 'bytes':
+        return put_challenge_frames_from_bytes(challenge_id, frames, frame_items, message, token_challenge)
+    if incremental_verification:
+        with span('UploadAndDetection'):
+            frame_items = map_frames(upload_frame_and_detect_faces, frames, frame_items)
+        return put_challenge_frames_incremental(challenge_id, frame_items, message, token_challenge)
+    # The valid token proves the challenge exists, so frames listed from the bucket need no item write
+    if not list_frames_from_s3 and append_frames(challenge_id, frame_items, token_challenge) is None:
+        return 404, {'message': 'Challenge not found'}
+    # Uploading frames to S3 bucket
+    with span('Upload'):
+        map_frames(upload_frame, frames, frame_items)
+    return 200, get_frames_response(message)
+
+
+# Updating challenge on DynamoDB table (a single update for all frames).
+# Returns None when the challenge does not exist.
+def append_frames(challenge_id, frame_items, token_challenge):
+    with span('WriteItem'):
+        stored_frames = store_frames(frame_items)
+    update = {
+        'Key': {'id': challenge_id},
+        'UpdateExpression': 'set #frames = list_append(if_not_exists(#frames, :empty_list), :frames)',
+        'ExpressionAttributeNames': {'#frames': 'frames'},
+        'ExpressionAttributeValues': {
+            ':empty_list': [],
+            ':frames': stored_frames
+        },
+        'ConditionExpression': 'attribute_exists(userId)',
+        'ReturnValues': 'NONE'
+    }
+    if incremental_verification:
+        # Uploads read back these timestamps instead of the frames and their Rekognition results
+        update['UpdateExpression'] += \
+            ', #timestamps = list_append(if_not_exists(#timestamps, :empty_list), :timestamps)'
+        update['ExpressionAttributeNames']['#timestamps'] = 'frameTimestamps'
+        update['ExpressionAttributeValues'][':timestamps'] = [frame.timestamp for frame in frame_items]
+    if token_challenge:
+        # The signed token proves the challenge exists: its parameters are written with its first frames
+        del update['ConditionExpression']
+        add_parameters(update, token_challenge)
     try:
-        table.update_item(
-            Key={'id': challenge_id},
-            UpdateExpression='set #frames = list_append(if_not_exists(#frames, :empty_list), :frame)',
-            ExpressionAttributeNames={'#frames': 'frames'},
-            ExpressionAttributeValues={
-                ':empty_list': [],
-                ':frame': [{
-                    'timestamp': timestamp,
-                    'key': frame_key
-                }]
-            },
-            ConditionExpression='attribute_exists(userId)',
-            ReturnValues='NONE'
-        )
+        with span('UpdateItem'):
+            return get_table().update_item(**update)
     except ClientError as error:
         if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
-            return 404, {'message': 'Challenge not found'}
+            return None
         raise error
-    # Uploading frame to S3 bucket
-    s3.put_object(
+
+
+# Adds the parameters of a stateless challenge to 'update' (unless they are already stored)
+def add_parameters(update, token_challenge):
+    for name in Challenge.PARAMETERS:
+        update['UpdateExpression'] += ', #{0} = if_not_exists(#{0}, :{0})'.format(name)
+        update['ExpressionAttributeNames']['#' + name] = name
+        update['ExpressionAttributeValues'][':' + name] = token_challenge[name]
+
+
+# Detects faces on the received bytes while frames are archived to the S3 bucket
+# (under the same keys) according to 'frame_archive_mode'
+def put_challenge_frames_from_bytes(challenge_id, frames, frame_items, message, token_challenge):
+    uploads = archive_frames(frames, frame_items)
+    try:
+        with span('Detection'):
+            frame_items = map_frames(detect_faces_in_bytes, frames, frame_items)
+        if incremental_verification:
+            return put_challenge_frames_incremental(challenge_id, frame_items, message, token_challenge)
+        if append_frames(challenge_id, frame_items, token_challenge) is None:
+            return 404, {'message': 'Challenge not found'}
+        return 200, get_frames_response(message)
+    finally:
+        # Synchronous archive writes overlap detection but complete before responding
+        with span('UploadWait'):
+            for upload in uploads:
+                upload.result()
+
+
+# Returns the archive writes the response has to wait for
+def archive_frames(frames, frame_items):
+    if frame_archive_mode == 'none':
+        return []
+    if frame_archive_mode not in ('deferred', 'sampled'):
+        return [archive_pool.submit(upload_frame, frame, frame_item)
+                for (_, frame), frame_item in zip(frames, frame_items)]
+    for (_, frame), frame_item in zip(frames, frame_items):
+        if frame_archive_mode == 'deferred' or is_archive_sample(frame_item):
+            # Best effort: the write may be lost if the container is shut down before it completes
+            archive_pool.submit(upload_frame_quietly, frame, frame_item)
+    return []
+
+
+# Sampling by content hash, so the same frame is always either archived or not
+def is_archive_sample(frame_item):
+    return int(frame_item.content_hash[:8], 16) < frame_archive_sample_rate * 2 ** 32
+
+
+# Applies 'func' to each (frame, frame item) pair, concurrently when there is more than one frame
+def map_frames(func, frames, frame_items):
+    frame_bytes = [frame for _, frame in frames]
+    if len(frames) == 1:
+        return [func(frame_bytes[0], frame_items[0])]
+    return list(upload_pool.map(func, frame_bytes, frame_items))
+
+
+def upload_frame(frame, frame_item):
+    get_s3().put_object(
         Body=frame,
         Bucket=bucket_name,
-        Key=frame_key
+        Key=frame_item.key
     )
-    return 200, {'message': 'Frame saved successfully'}
+    return frame_item
 
 
-def verify_challenge(challenge_id):
-    if not challenge_id:
-        return 422, {'message': 'Missing path parameter \'challengeId\''}
-    # Looking up challenge on DynamoDB table
-    item = table.get_item(Key={'id': challenge_id})
+def upload_frame_quietly(frame, frame_item):
+    try:
+        upload_frame(frame, frame_item)
+    except Exception:
+        logger.exception('Could not archive frame %s', frame_item.key)
+
+
+def upload_frame_and_detect_faces(frame, frame_item):
+    # Rekognition reads the frame from the S3 bucket
+    return detect_faces(upload_frame(frame, frame_item))
+
+
+def detect_faces_in_bytes(frame, frame_item):
+    return detect_faces(frame_item, frame)
+
+
+# Moves the challenge state forward with frames already analyzed on arrival,
+# so that verification only has to read back the already computed state
+def put_challenge_frames_incremental(challenge_id, frame_items, message, token_challenge):
+    if append_frames(challenge_id, frame_items, token_challenge) is None:
+        return 404, {'message': 'Challenge not found'}
+    parameters = token_challenge or get_cached_parameters(challenge_id)
+    # Only the state and the timestamps of the frames are read back, not their Rekognition results
+    names = PROGRESS_ATTRIBUTES if parameters else PROGRESS_ATTRIBUTES + Challenge.PARAMETERS
+    with span('GetItem'):
+        item = get_table().get_item(Key={'id': challenge_id}, ConsistentRead=True, **get_projection(names))
     if 'Item' not in item:
         return 404, {'message': 'Challenge not found'}
     challenge = read_item(item['Item'])
-    # Getting frames from challenge
-    frames = challenge['frames']
-    # Invoking Rekognition with parallel threads
-    with ThreadPoolExecutor(max_workers=10) as pool:
-        futures = [
-            pool.submit(
-                detect_faces, frame
-            ) for frame in frames
-        ]
-        frames = [r.result() for r in as_completed(futures)]
-    frames.sort(key=lambda frame: frame['key'])
-    # Setting up state manager
-    first_state = FaceState(challenge)
-    state_manager = StateManager(first_state)
-    current_state_name = state_manager.get_current_state_name()
-    # Processing Rekognition results with state manager
-    for frame in frames:
+    if parameters:
+        challenge.update(parameters)
+    else:
+        challenge_cache.put(challenge_id, challenge)
+    state = advance_state_snapshot(challenge_id, challenge, frame_items)
+    return 200, get_frames_response(message, state)
+
+
+# Hints for the client: the interval between uploads and, when frames are analyzed on arrival, the state
+# reached so far and whether more frames can still change the decision
+def get_frames_response(message, state=None):
+    response = {'message': message}
+    if frame_upload_interval_ms:
+        response['uploadIntervalMs'] = frame_upload_interval_ms
+    if state is not None:
+        response['state'] = state
+        response['stopUploading'] = state in StateManager.FINAL_STATES
+    return response
+
+
+# Starts the state machine of a challenge, or resumes it from a snapshot
+def create_state_manager(challenge, snapshot=None):
+    if state_engine == 'table':
+        if snapshot:
+            return InstrumentedStateEngine.from_snapshot(challenge, snapshot)
+        return InstrumentedStateEngine(challenge)
+    if snapshot:
+        return InstrumentedStateManager.from_snapshot(challenge, snapshot)
+    return InstrumentedStateManager(FaceState(challenge))
+
+
+# Returns the state reached with the frames of the challenge (None when it is unknown)
+def advance_state_snapshot(challenge_id, challenge, frame_items):
+    timestamps = sorted(challenge.get('frameTimestamps', []))
+    snapshot = challenge.get('stateSnapshot')
+    if snapshot:
+        if snapshot['state'] in StateManager.FINAL_STATES:
+            return snapshot['state']
+        # Frames that arrived out of order invalidate the snapshot (verification replays all frames)
+        if not is_snapshot_consistent(snapshot, timestamps):
+            return None
+        state_manager = create_state_manager(challenge, snapshot)
+        processed_frames = snapshot['processedFrames']
+    else:
+        state_manager = create_state_manager(challenge)
+        processed_frames = 0
+    state_manager.processed_frames = processed_frames
+    frames = get_pending_frames(challenge_id, timestamps[processed_frames:], processed_frames, frame_items)
+    new_snapshot = None
+    for index, frame in enumerate(frames, start=processed_frames + 1):
         state_manager.process(frame)
-        current_state_name = state_manager.get_current_state_name()
-        if current_state_name in {"SuccessState", "FailState"}:  # Final state
+        new_snapshot = state_manager.get_snapshot()
+        new_snapshot['lastTimestamp'] = frame.timestamp
+        new_snapshot['processedFrames'] = index
+        if state_manager.is_final():
             break
-    # Returning result based on final state
-    response = {'success': current_state_name == "SuccessState"}
+    if not new_snapshot:
+        return state_manager.get_current_state_name()
+    # Only one concurrent request succeeds in moving the snapshot forward from a given point
+    try:
+        with span('UpdateSnapshot'):
+            get_table().update_item(
+                Key={'id': challenge_id},
+                UpdateExpression='set #snapshot = :snapshot',
+                ExpressionAttributeNames={
+                    '#snapshot': 'stateSnapshot',
+                    '#processed': 'processedFrames'
+                },
+                ExpressionAttributeValues={
+                    ':snapshot': write_item(new_snapshot),
+                    ':processed': processed_frames
+                },
+                ConditionExpression='attribute_not_exists(#snapshot) OR #snapshot.#processed = :processed',
+                ReturnValues='NONE'
+            )
+    except ClientError as error:
+        if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise error
+    return state_manager.get_current_state_name()
+
+
+# Returns the frames that the snapshot has not processed yet, in timestamp order. They are usually the frames
+# of this request, which are already analyzed. Frames uploaded by concurrent requests (and not processed by
+# them) are read from the item.
+def get_pending_frames(challenge_id, pending_timestamps, processed_frames, frame_items):
+    frames_by_timestamp = {frame.timestamp: frame for frame in frame_items}
+    frames = [frames_by_timestamp.get(timestamp) for timestamp in pending_timestamps]
+    # Frames uploaded twice with the same timestamp are ordered as in the item
+    if None not in frames and len(set(pending_timestamps)) == len(pending_timestamps):
+        return frames
+    increment('PendingFrameReads')
+    with span('GetItem'):
+        item = get_table().get_item(Key={'id': challenge_id}, ConsistentRead=True, ProjectionExpression='#frames',
+                                    ExpressionAttributeNames={'#frames': 'frames'})
+    with span('ReadItem'):
+        frames = read_challenge(item.get('Item', {}))['frames']
+    return sorted(frames, key=lambda frame: frame.timestamp)[processed_frames:]
+
+
+def is_snapshot_consistent(snapshot, timestamps):
+    previous_frames = [timestamp for timestamp in timestamps if timestamp <= snapshot['lastTimestamp']]
+    return len(previous_frames) == snapshot['processedFrames']
+
+
+def is_snapshot_current(snapshot, timestamps):
+    if not is_snapshot_consistent(snapshot, timestamps):
+        return False
+    return snapshot['state'] in StateManager.FINAL_STATES or snapshot['processedFrames'] == len(timestamps)
+
+
+def verify_challenge(challenge_id, token_challenge):
+    if not challenge_id:
+        return 422, {'message': 'Missing path parameter \'challengeId\''}
+    if incremental_verification:
+        success = get_snapshot_decision(challenge_id)
+        if success is not None:
+            return 200, {'success': success}
+    challenge = get_challenge(challenge_id, token_challenge)
+    if challenge is None:
+        return 404, {'message': 'Challenge not found'}
+    success, frames = evaluate_challenge(challenge)
+    if result_write_mode == 'behind':
+        # Best effort: the result may be lost if the container is shut down before it is written
+        result_write_pool.submit(write_result_quietly, challenge_id, success, frames, token_challenge)
+    else:
+        write_result(challenge_id, success, frames, token_challenge)
+    return 200, {'success': success}
+
+
+# Returns the decision reached while frames were uploaded, reading only the snapshot and the frame timestamps,
+# or None when the snapshot does not cover every frame (which are then read and replayed)
+def get_snapshot_decision(challenge_id):
+    with span('GetItem'):
+        item = get_table().get_item(Key={'id': challenge_id}, ConsistentRead=True,
+                                    **get_projection(PROGRESS_ATTRIBUTES))
+    progress = read_item(item.get('Item', {}))
+    snapshot = progress.get('stateSnapshot')
+    timestamps = progress.get('frameTimestamps', [])
+    if not snapshot or not is_snapshot_current(snapshot, timestamps):
+        return None
+    success = snapshot['state'] == 'SuccessState'
+    # The write is conditional on the frames being those the timestamps were read for (frames appended before
+    # incremental verification was enabled have no timestamp), so that it is never based on a stale snapshot
+    try:
+        with span('UpdateItem'):
+            get_table().update_item(
+                Key={'id': challenge_id},
+                UpdateExpression='set #success = :success',
+                ExpressionAttributeNames={
+                    '#success': 'success',
+                    '#frames': 'frames',
+                    '#snapshot': 'stateSnapshot',
+                    '#processed': 'processedFrames'
+                },
+                ExpressionAttributeValues={
+                    ':success': success,
+                    ':frame_count': len(timestamps),
+                    ':processed': snapshot['processedFrames']
+                },
+                ConditionExpression='size(#frames) = :frame_count AND #snapshot.#processed = :processed',
+                ReturnValues='NONE'
+            )
+    except ClientError as error:
+        if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise error
+        return None
+    return success
+
+
+# Stores the decision and the frames (None when they did not change) in the challenge item
+def write_result(challenge_id, success, frames, token_challenge):
+    if frames is None:
+        with span('UpdateItem'):
+            get_table().update_item(
+                Key={'id': challenge_id},
+                UpdateExpression='set #success = :success',
+                ExpressionAttributeNames={'#success': 'success'},
+                ExpressionAttributeValues={':success': success},
+                ReturnValues='NONE'
+            )
+        return
+    with span('WriteItem'):
+        stored_frames = store_frames(frames)
     # Updating challenge on DynamoDB table
-    table.update_item(
-        Key={'id': challenge_id},
-        UpdateExpression='set #frames = :frames, #success = :success',
-        ExpressionAttributeNames={
+    update = {
+        'Key': {'id': challenge_id},
+        'UpdateExpression': 'set #frames = :frames, #success = :success',
+        'ExpressionAttributeNames': {
             '#frames': 'frames',
             '#success': 'success'
         },
-        ExpressionAttributeValues={
-            ':frames': write_item(frames),
-            ':success': response['success']
+        'ExpressionAttributeValues': {
+            ':frames': stored_frames,
+            ':success': success
         },
-        ReturnValues='NONE'
-    )
-    return 200, response
+        'ReturnValues': 'NONE'
+    }
+    if token_challenge and list_frames_from_s3:
+        # Stateless challenges with frames listed from the bucket have no item until now
+        add_parameters(update, token_challenge)
+    with span('UpdateItem'):
+        get_table().update_item(**update)
+
+
+def write_result_quietly(challenge_id, success, frames, token_challenge):
+    try:
+        write_result(challenge_id, success, frames, token_challenge)
+    except Exception:
+        logger.exception('Could not write the result of challenge %s', challenge_id)
+
+
+# Returns the challenge (parameters and frames), or None when it does not exist
+def get_challenge(challenge_id, token_challenge):
+    # Parameters are carried by the token of stateless challenges, and cached for recent ones
+    parameters = token_challenge or get_cached_parameters(challenge_id)
+    if list_frames_from_s3:
+        return get_listed_challenge(challenge_id, token_challenge, parameters)
+    # Looking up challenge on DynamoDB table (only its frames and state when its parameters are known)
+    with span('GetItem'):
+        item = get_table().get_item(Key={'id': challenge_id}, **get_challenge_projection(parameters))
+    if 'Item' not in item:
+        return None
+    with span('ReadItem'):
+        challenge = read_challenge(item['Item'])
+    if parameters:
+        challenge.update(parameters)
+    else:
+        challenge_cache.put(challenge_id, challenge)
+    return challenge
+
+
+def get_cached_parameters(challenge_id):
+    if not challenge_cache.is_enabled():
+        return None
+    parameters = challenge_cache.get(challenge_id)
+    increment('ChallengeCacheHits' if parameters else 'ChallengeCacheMisses')
+    return parameters
+
+
+# Frames are listed from the S3 bucket and parameters are read from the token (stateless challenges,
+# which then need no DynamoDB read), the challenge cache or the challenge item
+def get_listed_challenge(challenge_id, token_challenge, parameters):
+    with span('ListFrames'):
+        frames = list_frames(challenge_id)
+    if token_challenge:
+        # Stateless challenges only exist once they have frames
+        if not frames:
+            return None
+        challenge = dict(token_challenge)
+    elif parameters:
+        challenge = parameters
+    else:
+        with span('GetItem'):
+            item = get_table().get_item(Key={'id': challenge_id}, **get_projection(('id',) + Challenge.PARAMETERS))
+        if 'Item' not in item:
+            return None
+        challenge = read_item(item['Item'])
+        challenge_cache.put(challenge_id, challenge)
+    challenge['frames'] = frames
+    return challenge
+
+
+# Frames of the challenge in the S3 bucket. Their ETag (the MD5 of the bytes, for single part uploads
+# without KMS encryption) serves as content hash for the detection cache.
+def list_frames(challenge_id):
+    frames = []
+    paginator = get_s3().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix='{}/'.format(challenge_id)):
+        for s3_object in page.get('Contents', []):
+            match = FRAME_KEY_PATTERN.match(s3_object['Key'])
+            if match:
+                frames.append(FaceObservation(int(match.group(1)), s3_object['Key'],
+                                              content_hash=s3_object['ETag'].strip('"')))
+    return frames
+
+
+def get_projection(names):
+    return {
+        'ProjectionExpression': ', '.join('#' + name for name in names),
+        'ExpressionAttributeNames': {'#' + name: name for name in names}
+    }
+
+
+# Returns the decision on the challenge and its frames (with the Rekognition results obtained), or None as
+# frames when the decision was already computed while frames were uploaded
+def evaluate_challenge(challenge):
+    # Getting frames from challenge
+    frames = challenge['frames']
+    # Reading back the state computed while frames were uploaded
+    snapshot = challenge.get('stateSnapshot')
+    if snapshot and is_snapshot_current(snapshot, [frame.timestamp for frame in frames]):
+        return snapshot['state'] == 'SuccessState', None
+    frames = sorted(frames, key=lambda frame: frame.timestamp)
+    # Setting up state manager
+    state_manager = create_state_manager(challenge)
+    # Processing Rekognition results with state manager, in timestamp order, as soon as they are available
+    processed_frames = []
+    with closing(detect_faces_in_order(frames)) as detected_frames:
+        for frame in timed(detected_frames, 'Detection'):
+            processed_frames.append(frame)
+            state_manager.process(frame)
+            if state_manager.is_final():
+                break
+    # Frames after the final state are stored without being analyzed
+    frames = processed_frames + frames[len(processed_frames):]
+    # Counts since the container started
+    logger.info('Detection cache: %s', json.dumps(detection_cache.get_stats()))
+    # Returning result based on final state
+    return state_manager.get_current_state_name() == 'SuccessState', frames
+
+
+# Verifies many challenges in a single request (for reprocessing): challenges are read with BatchGetItem,
+# then evaluated and written back concurrently. Returns the outcome of each challenge.
+def verify_challenges(request):
+    entries = request.get('challenges')
+    if not isinstance(entries, list) or not entries:
+        return 400, {'message': 'Missing challenges'}
+    if len(entries) > MAX_CHALLENGES_PER_BATCH:
+        return 400, {'message': 'Too many challenges (maximum is {})'.format(MAX_CHALLENGES_PER_BATCH)}
+    outcomes = [None] * len(entries)
+    token_challenges = {}
+    with span('VerifyToken'):
+        secret = get_token_secret()
+        for index, entry in enumerate(entries):
+            if not is_valid_entry(entry):
+                outcomes[index] = {'statusCode': 400, 'message': 'Missing challengeId or token'}
+                continue
+            challenge_id = entry['challengeId']
+            claims = Token(challenge_id, secret).get_claims(entry['token'])
+            if claims is None:
+                outcomes[index] = {'statusCode': 403, 'message': 'Invalid token'}
+            else:
+                token_challenges[challenge_id] = Challenge.from_claims(challenge_id, claims)
+    with span('GetItem'):
+        items, unprocessed_ids = batch_get_challenges(list(token_challenges))
+    missing_ids = set()
+    if list_frames_from_s3:
+        # Stateless challenges with frames listed from the bucket have no item until verified
+        for challenge_id, token_challenge in token_challenges.items():
+            if token_challenge and challenge_id not in items and challenge_id not in unprocessed_ids:
+                items[challenge_id] = {'id': challenge_id}
+                missing_ids.add(challenge_id)
+    with span('Verification'):
+        decisions = bulk_verification_pool.map(evaluate_item, items.values(),
+                                               [token_challenges[key] for key in items])
+        decisions = {key: decision for key, decision in zip(items, decisions) if decision is not None}
+    increment('ChallengesVerified', len([decision for decision in decisions.values() if 'success' in decision]))
+    with span('WriteItem'):
+        written = bulk_verification_pool.map(
+            write_bulk_result, [items[key] for key in decisions], [key not in missing_ids for key in decisions],
+            [token_challenges[key] for key in decisions], decisions.values())
+        for challenge_id, outcome in zip(list(decisions), written):
+            decisions[challenge_id] = outcome
+    for index, entry in enumerate(entries):
+        if outcomes[index] is None:
+            outcomes[index] = get_outcome(entry['challengeId'], decisions, unprocessed_ids)
+        outcomes[index]['challengeId'] = entry.get('challengeId') if isinstance(entry, dict) else None
+    return 200, {'results': outcomes}
+
+
+def is_valid_entry(entry):
+    return (isinstance(entry, dict) and isinstance(entry.get('challengeId'), str) and entry['challengeId'] and
+            isinstance(entry.get('token'), str) and entry['token'])
+
+
+def get_outcome(challenge_id, decisions, unprocessed_ids):
+    if challenge_id in decisions:
+        return decisions[challenge_id]
+    if challenge_id in unprocessed_ids:
+        return {'statusCode': 503, 'message': 'Challenge could not be read, try again'}
+    return {'statusCode': 404, 'message': 'Challenge not found'}
+
+
+# Writes the decision and the frames of a challenge of a bulk verification, unless its item changed since it
+# was read (frames appended, state snapshot moved forward, or item created or deleted). Returns the outcome.
+def write_bulk_result(item, exists, token_challenge, decision):
+    if 'success' not in decision:
+        return decision
+    update = {
+        'Key': {'id': item['id']},
+        'UpdateExpression': 'set #success = :success',
+        'ExpressionAttributeNames': {'#id': 'id', '#success': 'success', '#frames': 'frames',
+                                     '#snapshot': 'stateSnapshot'},
+        'ExpressionAttributeValues': {':success': decision['success']},
+        'ReturnValues': 'NONE'
+    }
+    conditions = ['attribute_exists(#id)' if exists else 'attribute_not_exists(#id)']
+    if 'frames' in item:
+        conditions.append('size(#frames) = :frame_count')
+        update['ExpressionAttributeValues'][':frame_count'] = len(item['frames'])
+    else:
+        conditions.append('attribute_not_exists(#frames)')
+    if 'stateSnapshot' in item:
+        conditions.append('#snapshot.#processed = :processed')
+        update['ExpressionAttributeNames']['#processed'] = 'processedFrames'
+        update['ExpressionAttributeValues'][':processed'] = item['stateSnapshot']['processedFrames']
+    else:
+        conditions.append('attribute_not_exists(#snapshot)')
+    update['ConditionExpression'] = ' AND '.join(conditions)
+    if decision['frames'] is not None:
+        update['UpdateExpression'] += ', #frames = :frames'
+        update['ExpressionAttributeValues'][':frames'] = decision['frames']
+    if token_challenge:
+        add_parameters(update, token_challenge)
+    try:
+        get_table().update_item(**update)
+    except ClientError as error:
+        if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return {'statusCode': 409, 'message': 'Challenge changed during verification, try again'}
+        logger.exception('Could not write the result of challenge %s', item['id'])
+        return {'statusCode': 503, 'message': 'Challenge could not be written, try again'}
+    return {'statusCode': 200, 'success': decision['success']}
+
+
+# Returns the items found, by challenge id, and the ids of the challenges that could not be read
+# (left unprocessed by DynamoDB after all attempts)
+def batch_get_challenges(challenge_ids):
+    items = {}
+    table_name = get_table().name
+    keys = [{'id': challenge_id} for challenge_id in challenge_ids]
+    for attempt in range(BATCH_GET_MAX_ATTEMPTS):
+        if not keys:
+            break
+        if attempt:
+            time.sleep(BATCH_GET_BASE_DELAY_SECONDS * 2 ** attempt)
+        response = get_dynamodb().batch_get_item(RequestItems={table_name: {'Keys': keys}})
+        for item in response['Responses'].get(table_name, []):
+            items[item['id']] = item
+        keys = response.get('UnprocessedKeys', {}).get(table_name, {}).get('Keys', [])
+    return items, {key['id'] for key in keys}
+
+
+# Returns the decision on the challenge item and the frames to store (None when unchanged), the outcome
+# of the challenge when it could not be verified, or None when it does not exist
+def evaluate_item(item, token_challenge):
+    try:
+        challenge = read_challenge(item)
+        if token_challenge:
+            challenge.update(token_challenge)
+        if list_frames_from_s3:
+            challenge['frames'] = list_frames(item['id'])
+            if not challenge['frames'] and 'userId' not in item:
+                return None
+        success, frames = evaluate_challenge(challenge)
+        return {'success': success, 'frames': store_frames(frames) if frames is not None else None}
+    except Exception:
+        # Only this challenge fails (e.g. a frame Rekognition cannot read)
+        logger.exception('Could not verify challenge %s', item['id'])
+        return {'statusCode': 500, 'message': 'Challenge could not be verified'}
+
+
+def get_challenge_projection(parameters):
+    if not parameters:
+        return {}
+    # The id is projected as well, so that the item is returned even without frames
+    return {
+        'ProjectionExpression': '#id, #frames, #snapshot',
+        'ExpressionAttributeNames': {'#id': 'id', '#frames': 'frames', '#snapshot': 'stateSnapshot'}
+    }
+
+
+# Detects faces with parallel threads and yields the frames in the given order.
+# At most 'detection_window' frames of the request are in flight, so frames not yet submitted
+# when the generator is closed are never sent to the detector.
+def detect_faces_in_order(frames):
+    pending = deque()
+    remaining_frames = iter(frames)
+    try:
+        for frame in remaining_frames:
+            pending.append(submit_detect_faces(frame))
+            if len(pending) == detection_window:
+                break
+        while pending:
+            frame = pending.popleft().result()
+            next_frame = next(remaining_frames, None)
+            if next_frame is not None:
+                pending.append(submit_detect_faces(next_frame))
+            yield frame
+    finally:
+        for future in pending:
+            future.cancel()
 
 
-def detect_faces(frame):
-    frame['rekMetadata'] = rek.detect_faces(
-        Attributes=['ALL'],
-        Image={
-            'S3Object': {
-                'Bucket': bucket_name,
-                'Name': frame['key']
-            }
-        }
-    )['FaceDetails']
-    return frame
+def submit_detect_faces(frame):
+    # Frames analyzed on upload are not sent again
+    if frame.is_analyzed():
+        future = Future()
+        future.set_result(frame)
+        return future
+    return detection_pool.submit(detect_faces, frame)
 
 
-def read_item(item):
-    return json.loads(json.dumps(item, cls=DecimalEncoder))
+def detect_faces(frame, image_bytes=None):
+    attributes = face_metadata_profile['attributes']
+    if not frame.content_hash:
+        return frame.with_face_details(face_detector.detect(frame, attributes, image_bytes))
+    face_details = detection_cache.get_or_detect(frame.content_hash, attributes,
+                                                 lambda: face_detector.detect(frame, attributes, image_bytes))
+    return frame.with_face_details(face_details)
 
 
-def write_item(item):
-    return json.loads(json.dumps(item), parse_float=decimal.Decimal)
+# Frames are read as FaceObservation objects, the rest of the challenge as plain values
+def read_challenge(item):
+    challenge = read_item({key: value for key, value in item.items() if key != 'frames'})
+    challenge['frames'] = [FaceObservation.from_item(frame) for frame in item.get('frames', [])]
+    return challenge
 
 
-# Helper class to convert a DynamoDB item to JSON.
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, decimal.Decimal):
-            if o % 1 > 0:
-                return float(o)
-            return int(o)
-        return super(DecimalEncoder, self).default(o)
+def store_frames(frames):
+    return [frame.to_item(face_metadata_profile) for frame in frames]
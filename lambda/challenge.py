@@ -18,9 +18,11 @@ class Challenge:
     NOSE_BOX_CENTER_MIN_H_DIST = 45
     NOSE_BOX_CENTER_MAX_H_DIST = 75
     NOSE_BOX_CENTER_MAX_V_DIST = 40
+    # Signed into stateless tokens, so that the challenge can be rebuilt without reading it back
+    PARAMETERS = ('userId', 'imageWidth', 'imageHeight', 'areaLeft', 'areaTop', 'areaWidth', 'areaHeight',
+                  'minFaceAreaPercent', 'noseLeft', 'noseTop', 'noseWidth', 'noseHeight')
 
-
-    def __init__(self, user_id, image_width, image_height, token_secret):
+    def __init__(self, user_id, image_width, image_height, token_secret, stateless=False, token_ttl_seconds=None):
         area_x, area_y, area_w, area_h = Challenge.get_area_box(image_width, image_height)
         nose_x, nose_y, nose_w, nose_h = Challenge.get_nose_box(image_width, image_height)
         self.id = str(uuid.uuid1())
@@ -36,7 +38,17 @@ class Challenge:
         self.noseTop = int(nose_y)
         self.noseWidth = int(nose_w)
         self.noseHeight = int(nose_h)
-        self.token = Token(self.id, token_secret).get_jwt()
+        claims = {name: getattr(self, name) for name in Challenge.PARAMETERS} if stateless else None
+        self.token = Token(self.id, token_secret, claims, token_ttl_seconds).get_jwt()
+
+    # The challenge parameters carried by stateless tokens, otherwise None
+    @staticmethod
+    def from_claims(challenge_id, claims):
+        if any(name not in claims for name in Challenge.PARAMETERS):
+            return None
+        challenge = {name: claims[name] for name in Challenge.PARAMETERS}
+        challenge['id'] = challenge_id
+        return challenge
 
     @staticmethod
     def get_area_box(image_width, image_height):
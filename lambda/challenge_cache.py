@@ -0,0 +1,50 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import threading
+import time
+
+from collections import OrderedDict
+
+from challenge import Challenge
+
+
+# Caches the parameters of recent challenges, which never change once a challenge is started, so that a warm
+# container (or a long-running server) does not read them back from DynamoDB, which remains the source of truth.
+# A cached challenge is known to exist in the table. Frames are not cached, as the frames of a challenge may be
+# uploaded through other containers. Entries expire 'ttl_seconds' after being added, and the least recently
+# used ones are evicted beyond 'max_size'.
+class ChallengeCache:
+
+    def __init__(self, max_size, ttl_seconds):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def is_enabled(self):
+        return self.max_size > 0
+
+    # Returns the id and parameters of the challenge, or None when it is not cached
+    def get(self, challenge_id):
+        with self.lock:
+            entry = self.entries.get(challenge_id)
+            if entry is None:
+                return None
+            expires_at, parameters = entry
+            if expires_at < time.monotonic():
+                del self.entries[challenge_id]
+                return None
+            self.entries.move_to_end(challenge_id)
+        return dict(parameters)
+
+    def put(self, challenge_id, challenge):
+        if not self.is_enabled() or any(name not in challenge for name in Challenge.PARAMETERS):
+            return
+        parameters = {name: challenge[name] for name in Challenge.PARAMETERS}
+        parameters['id'] = challenge_id
+        with self.lock:
+            self.entries[challenge_id] = (time.monotonic() + self.ttl_seconds, parameters)
+            self.entries.move_to_end(challenge_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
@@ -0,0 +1,132 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import logging
+import os
+import threading
+import time
+
+import boto3
+from botocore.config import Config
+
+region_name = os.getenv('REGION_NAME')
+dynamo_table = os.getenv('DDB_TABLE')
+detection_cache_table = os.getenv('DETECTION_CACHE_TABLE')
+token_secret_arn = os.getenv('TOKEN_SECRET_ARN')
+token_secret_ttl = int(os.getenv('TOKEN_SECRET_TTL_SECONDS', '300'))
+# Connections kept open to each service, shared by all threads of the process
+max_pool_connections = int(os.getenv('MAX_POOL_CONNECTIONS', '10'))
+
+logger = logging.getLogger()
+
+# Clients are created on first use, so each route only pays for the clients it needs. The threads of the
+# detection and upload pools may ask for a client at the same time, so each one is created once, under a lock,
+# from a session of its own (boto3's default session is not thread-safe).
+created_clients = {}
+# Reentrant, as tables are created from the DynamoDB resource
+clients_lock = threading.RLock()
+
+
+def get_s3():
+    return get_client('s3', lambda: create_client('s3'))
+
+
+# Throttled calls, server errors and connection failures are retried by the detection layer, which also adapts
+# its concurrency to throttling
+def get_rekognition():
+    return get_client('rekognition', lambda: create_client('rekognition', config=Config(retries={'max_attempts': 0})))
+
+
+def get_dynamodb():
+    return get_client('dynamodb', lambda: create_resource('dynamodb'))
+
+
+def get_table():
+    return get_client('table', lambda: get_dynamodb().Table(dynamo_table))
+
+
+def get_detection_cache_table():
+    return get_client('detectionCacheTable', lambda: get_dynamodb().Table(detection_cache_table))
+
+
+def get_client(name, create):
+    client = created_clients.get(name)
+    if client is None:
+        with clients_lock:
+            client = created_clients.get(name)
+            if client is None:
+                client = created_clients[name] = create()
+    return client
+
+
+def get_session():
+    return get_client('session', boto3.session.Session)
+
+
+def create_client(service_name, config=None):
+    return get_session().client(service_name, region_name=region_name, config=get_config(config))
+
+
+def create_resource(service_name):
+    return get_session().resource(service_name, region_name=region_name, config=get_config())
+
+
+def get_config(config=None):
+    pool_config = Config(max_pool_connections=max_pool_connections)
+    return pool_config.merge(config) if config else pool_config
+
+
+def get_token_secret():
+    return token_secret_cache.get()
+
+
+def fetch_token_secret():
+    from aws_lambda_powertools.utilities import parameters
+    return parameters.get_secret(token_secret_arn, force_fetch=True)
+
+
+# Caches the secret for 'ttl' seconds. Within the last 'refresh_ratio' of its lifetime the cached value is
+# still returned, while a background thread fetches a new one, so requests never wait for a refresh.
+class SecretCache:
+
+    def __init__(self, fetch, ttl, refresh_ratio=0.2):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.refresh_ratio = refresh_ratio
+        self.value = None
+        self.expires_at = 0
+        self.refreshing = False
+        self.lock = threading.Lock()
+
+    def get(self):
+        now = time.monotonic()
+        if self.value is None or now >= self.expires_at:
+            with self.lock:
+                if self.value is None or time.monotonic() >= self.expires_at:
+                    self.store(self.fetch())
+        elif now >= self.expires_at - self.ttl * self.refresh_ratio:
+            with self.lock:
+                start_refresh = not self.refreshing
+                self.refreshing = True
+            if start_refresh:
+                threading.Thread(target=self.refresh, daemon=True).start()
+        return self.value
+
+    def refresh(self):
+        try:
+            value = self.fetch()
+            with self.lock:
+                self.store(value)
+        except Exception:
+            # The cached value is still returned until it expires, when requests fetch it themselves
+            logger.exception('Could not refresh the secret')
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+    def store(self, value):
+        self.value = value
+        self.expires_at = time.monotonic() + self.ttl
+
+
+token_secret_cache = SecretCache(fetch_token_secret, token_secret_ttl)
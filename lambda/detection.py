@@ -0,0 +1,175 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import random
+import threading
+import time
+import zlib
+
+from botocore.exceptions import ClientError, HTTPClientError
+from botocore.exceptions import ConnectionError as BotocoreConnectionError
+
+from face_metadata import LANDMARK_TYPES
+
+THROTTLING_ERROR_CODES = {
+    'ThrottlingException',
+    'ProvisionedThroughputExceededException',
+    'LimitExceededException',
+    'TooManyRequestsException'
+}
+# Failures that a later attempt may not hit (botocore's retries are disabled for Rekognition)
+TRANSIENT_ERROR_CODES = {
+    'InternalServerError',
+    'ServiceUnavailableException',
+    'RequestTimeout',
+    'RequestTimeoutException'
+}
+
+
+def create_detector(name, get_client, bucket_name):
+    if name == 'rekognition':
+        return RekognitionDetector(get_client, bucket_name)
+    if name == 'local':
+        return LocalDetector()
+    raise ValueError('Unknown face detector: {}'.format(name))
+
+
+# Detects faces with Amazon Rekognition, sending the frame bytes when given or else
+# letting Rekognition read the frame from the S3 bucket
+class RekognitionDetector:
+
+    def __init__(self, get_client, bucket_name):
+        self.get_client = get_client
+        self.bucket_name = bucket_name
+
+    def detect(self, frame, attributes, image_bytes=None):
+        if image_bytes is not None:
+            image = {'Bytes': image_bytes}
+        else:
+            image = {
+                'S3Object': {
+                    'Bucket': self.bucket_name,
+                    'Name': frame.key
+                }
+            }
+        return self.get_client().detect_faces(Attributes=attributes, Image=image)['FaceDetails']
+
+
+# Deterministic stand-in for tests and benchmarks: returns the given results for known frame keys and,
+# for any other frame, a single centered face whose details depend only on the frame key
+class LocalDetector:
+
+    def __init__(self, results=None, latency=0.0):
+        self.results = results if results is not None else {}
+        self.latency = latency
+
+    def detect(self, frame, _, image_bytes=None):
+        if self.latency:
+            time.sleep(self.latency)
+        if frame.key in self.results:
+            return self.results[frame.key]
+        offset = (zlib.crc32(frame.key.encode()) % 100) / 10000
+        landmarks = [{
+            'Type': landmark_type,
+            'X': 0.4 + offset + 0.2 * (index % 5) / 4,
+            'Y': 0.3 + offset + 0.4 * (index // 5) / 5
+        } for index, landmark_type in enumerate(LANDMARK_TYPES)]
+        return [{
+            'BoundingBox': {'Left': 0.36 + offset, 'Top': 0.21 + offset, 'Width': 0.28, 'Height': 0.54},
+            'Landmarks': landmarks,
+            'Pose': {'Yaw': 0.0, 'Roll': 0.0, 'Pitch': 0.0},
+            'Confidence': 99.9
+        }]
+
+
+# Wraps a detector with a token bucket (requests per second), an AIMD concurrency limit that
+# shrinks on throttling responses, and retries with jittered exponential backoff of throttled calls,
+# server errors and connection failures
+class RateControlledDetector:
+
+    def __init__(self, detector, rate, min_concurrency, max_concurrency, max_attempts,
+                 base_delay=0.05, max_delay=2.0):
+        self.detector = detector
+        self.token_bucket = TokenBucket(rate, burst=max(1, max_concurrency))
+        self.limiter = AimdLimiter(min_concurrency, max_concurrency)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.throttles = 0
+
+    def detect(self, frame, attributes, image_bytes=None):
+        for attempt in range(1, self.max_attempts + 1):
+            self.limiter.acquire()
+            throttled = False
+            try:
+                self.token_bucket.acquire()
+                return self.detector.detect(frame, attributes, image_bytes)
+            except ClientError as error:
+                throttled = error.response['Error']['Code'] in THROTTLING_ERROR_CODES
+                if not (throttled or is_transient(error)) or attempt == self.max_attempts:
+                    raise error
+                if throttled:
+                    self.throttles += 1
+            except (BotocoreConnectionError, HTTPClientError) as error:
+                if attempt == self.max_attempts:
+                    raise error
+            finally:
+                self.limiter.release(throttled)
+            # Full jitter: spreads retries of concurrent requests over the backoff window
+            time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+
+
+def is_transient(error):
+    if error.response['Error']['Code'] in TRANSIENT_ERROR_CODES:
+        return True
+    return error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500
+
+
+class TokenBucket:
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# Additive increase (one more slot per limit's worth of successful calls), multiplicative decrease on throttling
+class AimdLimiter:
+
+    DECREASE_FACTOR = 0.5
+
+    def __init__(self, min_limit, max_limit):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.min_limit, self.limit * AimdLimiter.DECREASE_FACTOR)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.condition.notify_all()
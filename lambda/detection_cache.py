@@ -0,0 +1,109 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from items import read_item, write_item
+
+logger = logging.getLogger()
+
+
+# Caches Rekognition results by the hash of the frame bytes, so that a repeated frame (static camera,
+# retries, duplicate timestamps) is analyzed only once. Results are kept in an in-process LRU (which
+# survives across invocations of a warm container) and, optionally, in a DynamoDB table with TTL.
+class DetectionCache:
+
+    def __init__(self, max_size, get_table=None, ttl_seconds=86400):
+        self.max_size = max_size
+        self.get_table = get_table
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'persistentHits': 0, 'misses': 0, 'persistentErrors': 0}
+
+    # Returns the cached result for the key, or the result of 'detect' (called at most once per key,
+    # even if the same key is requested concurrently)
+    def get_or_detect(self, content_hash, attributes, detect):
+        key = '{}:{}'.format(content_hash, ','.join(attributes))
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return self.entries[key]
+            future = self.in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self.in_flight[key] = Future()
+            else:
+                self.stats['hits'] += 1
+        if not owner:
+            return future.result()
+        try:
+            face_details = self.get_persistent(key)
+            if face_details is None:
+                face_details = detect()
+                self.put_persistent(key, face_details)
+                self.count('misses')
+            else:
+                self.count('persistentHits')
+            self.put(key, face_details)
+            future.set_result(face_details)
+            return face_details
+        except Exception as error:
+            future.set_exception(error)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+    def put(self, key, face_details):
+        with self.lock:
+            self.entries[key] = face_details
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    # The table is only an optimization: when it cannot be read (throttling, missing table or permission),
+    # the lookup is a miss, and a failed write is ignored
+    def get_persistent(self, key):
+        if not self.get_table:
+            return None
+        try:
+            item = self.get_table().get_item(Key={'hash': key}).get('Item')
+        except (BotoCoreError, ClientError):
+            logger.exception('Could not read the detection cache table')
+            self.count('persistentErrors')
+            return None
+        # DynamoDB deletes expired items lazily, so the expiration is checked as well
+        if not item or item['expiresAt'] < time.time():
+            return None
+        return read_item(item['faceDetails'])
+
+    def put_persistent(self, key, face_details):
+        if not self.get_table:
+            return
+        try:
+            self.get_table().put_item(Item={
+                'hash': key,
+                'faceDetails': write_item(face_details),
+                'expiresAt': int(time.time()) + self.ttl_seconds
+            })
+        except (BotoCoreError, ClientError):
+            logger.exception('Could not write to the detection cache table')
+            self.count('persistentErrors')
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
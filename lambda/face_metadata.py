@@ -0,0 +1,27 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Attributes requested from Rekognition and how its results are stored in the challenge item:
+# - full: all attributes, stored as returned by Rekognition ('rekMetadata')
+# - default: only the default attributes (bounding box, pose, landmarks, quality), stored as returned
+# - compact: only the default attributes, stored as a compact record ('rekCompact') with what the states use
+PROFILES = {
+    'full': {'attributes': ['ALL'], 'compact': False},
+    'default': {'attributes': ['DEFAULT'], 'compact': False},
+    'compact': {'attributes': ['DEFAULT'], 'compact': True}
+}
+
+LANDMARK_TYPES = [
+    'eyeLeft', 'eyeRight', 'nose', 'mouthLeft', 'mouthRight',
+    'leftEyeBrowLeft', 'leftEyeBrowRight', 'leftEyeBrowUp',
+    'rightEyeBrowLeft', 'rightEyeBrowRight', 'rightEyeBrowUp',
+    'leftEyeLeft', 'leftEyeRight', 'leftEyeUp', 'leftEyeDown',
+    'rightEyeLeft', 'rightEyeRight', 'rightEyeUp', 'rightEyeDown',
+    'noseLeft', 'noseRight', 'mouthUp', 'mouthDown', 'leftPupil', 'rightPupil',
+    'upperJawlineLeft', 'midJawlineLeft', 'chinBottom', 'midJawlineRight', 'upperJawlineRight'
+]
+
+# Fixed-point scales of the quantized values in compact records (all stored as little-endian 16-bit integers)
+BOX_SCALE = 10000
+LANDMARK_SCALE = 10000
+YAW_SCALE = 100
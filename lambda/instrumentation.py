@@ -0,0 +1,186 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import collections
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+
+from states.engine import StateEngine
+from states.manager import StateManager
+
+metrics_enabled = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+metrics_namespace = os.getenv('METRICS_NAMESPACE', 'LivenessDetection')
+
+logger = logging.getLogger()
+
+current_request = ContextVar('current_request', default=None)
+publish_lock = threading.Lock()
+
+
+# Timings (in milliseconds, summed by name) and counters of a request, published as CloudWatch metrics
+class RequestMetrics:
+
+    def __init__(self, route):
+        self.route = route
+        self.timings = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+
+    def add_timing(self, name, milliseconds):
+        self.timings[name] = self.timings.get(name, 0.0) + milliseconds
+
+    def increment(self, name, value):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+
+@contextmanager
+def instrument_request(route, profile=False):
+    request = RequestMetrics(route)
+    token = current_request.set(request)
+    profiler = SamplingProfiler() if profile else None
+    start = time.perf_counter()
+    try:
+        if profiler:
+            profiler.start()
+        yield request
+    finally:
+        request.add_timing('Total', (time.perf_counter() - start) * 1000)
+        current_request.reset(token)
+        if profiler:
+            profiler.stop()
+            logger.info('Profile (%s): %s', route, json.dumps(profiler.get_top_stacks()))
+        publish(request)
+
+
+# Times the enclosed block in the current request (if any)
+@contextmanager
+def span(name):
+    request = current_request.get()
+    if request is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        request.add_timing(name, (time.perf_counter() - start) * 1000)
+
+
+# Times the wait for each item of 'iterable'
+def timed(iterable, name):
+    iterator = iter(iterable)
+    while True:
+        with span(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def increment(name, value=1):
+    request = current_request.get()
+    if request is not None:
+        request.increment(name, value)
+
+
+def publish(request):
+    if not metrics_enabled:
+        return
+    from aws_lambda_powertools.metrics import MetricUnit
+    metrics = get_metrics()
+    # The metrics object accumulates a single document, which requests handled on other threads (server.py)
+    # must not add to before it is printed
+    with publish_lock:
+        if request.route:
+            metrics.add_dimension(name='Route', value=request.route)
+        for name, milliseconds in request.timings.items():
+            metrics.add_metric(name='{}Time'.format(name), unit=MetricUnit.Milliseconds, value=milliseconds)
+        for name, value in request.counters.items():
+            metrics.add_metric(name=name, unit=MetricUnit.Count, value=value)
+        # Printed as Embedded Metric Format, which CloudWatch Logs turns into metrics
+        metrics.flush_metrics()
+
+
+# Powertools is imported on the first publication, so that it does not add to the import time
+@lru_cache(maxsize=None)
+def get_metrics():
+    from aws_lambda_powertools import Metrics
+    return Metrics(namespace=metrics_namespace, service='challenge')
+
+
+# Counts frames processed, state transitions and the frames needed to reach a final state
+class StateMetrics:
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.processed_frames = 0
+
+    def process(self, frame):
+        state_name = self.get_current_state_name()
+        with span('StateMachine'):
+            super().process(frame)
+        self.processed_frames += 1
+        increment('FramesProcessed')
+        new_state_name = self.get_current_state_name()
+        if new_state_name != state_name:
+            increment('TransitionsTo{}'.format(new_state_name))
+            if self.is_final():
+                increment('FramesBeforeFinalState', self.processed_frames)
+
+
+class InstrumentedStateManager(StateMetrics, StateManager):
+    pass
+
+
+class InstrumentedStateEngine(StateMetrics, StateEngine):
+    pass
+
+
+# Periodically records the stacks of all threads (including the detection pool's)
+class SamplingProfiler:
+
+    INTERVAL_SECONDS = 0.005
+    TOP_STACKS = 20
+    MAX_DEPTH = 12
+    # Idle thread pool workers, waiting for tasks
+    IDLE_FUNCTIONS = {'_worker'}
+
+    def __init__(self):
+        self.samples = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self.stopped.wait(SamplingProfiler.INTERVAL_SECONDS):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id and frame.f_code.co_name not in SamplingProfiler.IDLE_FUNCTIONS:
+                    self.samples[SamplingProfiler.get_stack(frame)] += 1
+
+    @staticmethod
+    def get_stack(frame):
+        names = []
+        while frame is not None and len(names) < SamplingProfiler.MAX_DEPTH:
+            code = frame.f_code
+            names.append('{}:{}:{}'.format(os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def get_top_stacks(self):
+        return [{'stack': stack, 'samples': samples}
+                for stack, samples in self.samples.most_common(SamplingProfiler.TOP_STACKS)]
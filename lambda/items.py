@@ -0,0 +1,28 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import decimal
+
+
+# Converts a DynamoDB item (numbers as Decimals) to plain Python values
+def read_item(item):
+    if isinstance(item, dict):
+        return {key: read_item(value) for key, value in item.items()}
+    if isinstance(item, list):
+        return [read_item(value) for value in item]
+    if isinstance(item, decimal.Decimal):
+        if item == item.to_integral_value():
+            return int(item)
+        return float(item)
+    return item
+
+
+# Converts plain Python values to a DynamoDB item (floats as Decimals)
+def write_item(item):
+    if isinstance(item, dict):
+        return {key: write_item(value) for key, value in item.items()}
+    if isinstance(item, (list, tuple)):
+        return [write_item(value) for value in item]
+    if isinstance(item, float):
+        return decimal.Decimal(repr(item))
+    return item
@@ -1,6 +1,8 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import time
+
 import jwt
 
 
@@ -8,19 +10,26 @@ class Token:
 
     JWT_ALGORITHM = 'HS256'
 
-    def __init__(self, challenge_id, secret):
+    def __init__(self, challenge_id, secret, claims=None, ttl_seconds=None):
         self.challenge_id = challenge_id
         self.secret = secret
+        self.claims = claims
+        self.ttl_seconds = ttl_seconds
 
     def get_jwt(self):
-        payload = {
-            'challengeId': self.challenge_id
-        }
+        payload = dict(self.claims or {})
+        payload['challengeId'] = self.challenge_id
+        if self.ttl_seconds:
+            payload['exp'] = int(time.time()) + self.ttl_seconds
         return jwt.encode(payload, self.secret, algorithm=Token.JWT_ALGORITHM)
 
     def verify_jwt(self, token):
+        return self.get_claims(token) is not None
+
+    # Returns the payload of a valid (and not expired) token for this challenge, otherwise None
+    def get_claims(self, token):
         try:
             decoded = jwt.decode(token, self.secret, algorithms=Token.JWT_ALGORITHM)
-            return decoded['challengeId'] == self.challenge_id
         except jwt.exceptions.InvalidTokenError:
-            return False
+            return None
+        return decoded if decoded['challengeId'] == self.challenge_id else None
@@ -0,0 +1,160 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import base64
+
+from face_metadata import BOX_SCALE, LANDMARK_SCALE, LANDMARK_TYPES, YAW_SCALE
+from items import write_item
+
+# NumPy is imported by the methods that use it, so that routes that don't analyze frames don't pay for it
+
+LANDMARK_INDEXES = {landmark_type: index for index, landmark_type in enumerate(LANDMARK_TYPES)}
+
+
+# A frame of the challenge and, once analyzed, what Rekognition observed in it: the bounding box and yaw of
+# every face (arrays of shape (faces, 4) and (faces,)) and the landmarks of the first face (shape (landmarks, 2)).
+# All coordinates are relative to the image size.
+class FaceObservation:
+
+    __slots__ = ('timestamp', 'key', 'content_hash', 'face_count', 'boxes', 'yaws', 'landmarks', 'landmark_types',
+                 'landmark_indexes', 'bounding_box', 'yaw', 'face_details')
+
+    def __init__(self, timestamp, key, boxes=None, yaws=None, landmarks=None, landmark_types=LANDMARK_TYPES,
+                 face_details=None, content_hash=None):
+        self.timestamp = timestamp
+        self.key = key
+        # Hash of the frame bytes (used to cache Rekognition results)
+        self.content_hash = content_hash
+        self.face_count = len(yaws) if yaws is not None else None
+        self.boxes = boxes
+        self.yaws = yaws
+        self.landmarks = landmarks
+        self.landmark_types = landmark_types
+        if landmark_types is LANDMARK_TYPES:
+            self.landmark_indexes = LANDMARK_INDEXES
+        else:
+            self.landmark_indexes = {landmark_type: index for index, landmark_type in enumerate(landmark_types)}
+        # First face (the one the states look at), as plain floats
+        self.bounding_box = tuple(float(value) for value in boxes[0]) if self.face_count else None
+        self.yaw = float(yaws[0]) if self.face_count else None
+        # Rekognition response, kept only to be stored as returned
+        self.face_details = face_details
+
+    def is_analyzed(self):
+        return self.face_count is not None
+
+    def get_bounding_box(self, image_width, image_height):
+        left, top, width, height = self.bounding_box
+        return [image_width * left, image_height * top, image_width * width, image_height * height]
+
+    def get_landmark(self, landmark_type):
+        index = self.landmark_indexes.get(landmark_type)
+        if index is None or self.landmarks is None:
+            return None
+        return float(self.landmarks[index, 0]), float(self.landmarks[index, 1])
+
+    def with_face_details(self, face_details):
+        return FaceObservation.from_face_details(self.timestamp, self.key, face_details, self.content_hash)
+
+    @staticmethod
+    def from_face_details(timestamp, key, face_details, content_hash=None):
+        import numpy as np
+        boxes = np.array([(face['BoundingBox']['Left'], face['BoundingBox']['Top'],
+                           face['BoundingBox']['Width'], face['BoundingBox']['Height'])
+                          for face in face_details], dtype=float).reshape(-1, 4)
+        yaws = np.array([face['Pose']['Yaw'] for face in face_details], dtype=float)
+        landmarks = None
+        landmark_types = LANDMARK_TYPES
+        if face_details:
+            first_face_landmarks = face_details[0]['Landmarks']
+            landmark_types = [landmark['Type'] for landmark in first_face_landmarks]
+            if landmark_types == LANDMARK_TYPES:
+                landmark_types = LANDMARK_TYPES
+            landmarks = np.array([(landmark['X'], landmark['Y']) for landmark in first_face_landmarks],
+                                 dtype=float).reshape(-1, 2)
+        return FaceObservation(timestamp, key, boxes, yaws, landmarks, landmark_types, face_details, content_hash)
+
+    # Reads a frame of a DynamoDB challenge item (numbers may be Decimals)
+    @staticmethod
+    def from_item(item):
+        timestamp = int(item['timestamp'])
+        content_hash = item.get('hash')
+        if 'rekMetadata' in item:
+            return FaceObservation.from_face_details(timestamp, item['key'], item['rekMetadata'], content_hash)
+        if 'rekCompact' in item:
+            record = item['rekCompact']
+            face_count = int(record['faces'])
+            landmarks = None
+            if face_count:
+                landmarks = unpack(record['landmarks'], LANDMARK_SCALE).reshape(-1, 2)
+            return FaceObservation(timestamp, item['key'],
+                                   unpack(record['boxes'], BOX_SCALE).reshape(-1, 4),
+                                   unpack(record['yaws'], YAW_SCALE),
+                                   landmarks,
+                                   record.get('landmarkTypes', LANDMARK_TYPES),
+                                   content_hash=content_hash)
+        return FaceObservation(timestamp, item['key'], content_hash=content_hash)
+
+    # Returns the frame as it should be stored in a DynamoDB challenge item, according to the profile
+    def to_item(self, profile):
+        item = {
+            'timestamp': self.timestamp,
+            'key': self.key
+        }
+        if self.content_hash:
+            item['hash'] = self.content_hash
+        if not self.is_analyzed():
+            return item
+        if profile['compact'] or self.face_details is None:
+            item['rekCompact'] = self.get_compact_record()
+        else:
+            item['rekMetadata'] = write_item(self.face_details)
+        return item
+
+    # Keeps the bounding box and yaw of every face, and the landmarks of the first one (the only ones the states use)
+    def get_compact_record(self):
+        record = {
+            'faces': self.face_count,
+            'boxes': pack(self.boxes, BOX_SCALE),
+            'yaws': pack(self.yaws, YAW_SCALE)
+        }
+        if self.face_count:
+            if self.landmark_types is not LANDMARK_TYPES:
+                record['landmarkTypes'] = list(self.landmark_types)
+            record['landmarks'] = pack(self.landmarks, LANDMARK_SCALE)
+        return record
+
+    # Lossless plain representation (used in state snapshots)
+    def to_snapshot(self):
+        snapshot = {
+            'timestamp': self.timestamp,
+            'key': self.key,
+            'boxes': self.boxes.tolist(),
+            'yaws': self.yaws.tolist(),
+            'landmarks': self.landmarks.tolist() if self.landmarks is not None else None
+        }
+        if self.landmark_types is not LANDMARK_TYPES:
+            snapshot['landmarkTypes'] = list(self.landmark_types)
+        return snapshot
+
+    @staticmethod
+    def from_snapshot(snapshot):
+        import numpy as np
+        landmarks = np.array(snapshot['landmarks'], dtype=float) if snapshot['landmarks'] is not None else None
+        return FaceObservation(snapshot['timestamp'], snapshot['key'],
+                               np.array(snapshot['boxes'], dtype=float).reshape(-1, 4),
+                               np.array(snapshot['yaws'], dtype=float),
+                               landmarks,
+                               snapshot.get('landmarkTypes', LANDMARK_TYPES))
+
+
+# Values are stored as base64 encoded, little-endian, 16-bit fixed-point integers
+def pack(values, scale):
+    import numpy as np
+    quantized = np.clip(np.round(np.asarray(values, dtype=float) * scale), -32768, 32767).astype('<i2')
+    return base64.b64encode(quantized.tobytes()).decode('ascii')
+
+
+def unpack(packed, scale):
+    import numpy as np
+    return np.frombuffer(base64.b64decode(packed), dtype='<i2') / scale
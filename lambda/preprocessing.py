@@ -0,0 +1,44 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import io
+import logging
+
+logger = logging.getLogger()
+
+
+# Downscales frames to a maximum short side and re-encodes them as JPEG, before they are stored and analyzed.
+# The aspect ratio is kept, so the normalized boxes and landmarks returned by Rekognition still apply to the
+# challenge's imageWidth and imageHeight.
+class FramePreprocessor:
+
+    def __init__(self, max_short_side, quality):
+        self.max_short_side = max_short_side
+        self.quality = quality
+
+    def is_enabled(self):
+        return self.max_short_side > 0
+
+    # Returns the frame to store and analyze (the received one when it is already small enough or not an image)
+    def process(self, frame):
+        # Pillow is only imported when preprocessing is enabled
+        from PIL import Image
+        try:
+            # Only the header is read until the image is loaded
+            image = Image.open(io.BytesIO(frame))
+            width, height = image.size
+            if min(width, height) <= self.max_short_side:
+                return frame
+            scale = self.max_short_side / min(width, height)
+            size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            # JPEGs are decoded directly at a reduced scale (1/2, 1/4 or 1/8) no smaller than the target size
+            image.draft('RGB', size)
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            image = image.resize(size, Image.BILINEAR)
+            output = io.BytesIO()
+            image.save(output, format='JPEG', quality=self.quality)
+        except (OSError, ValueError, Image.DecompressionBombError) as error:
+            logger.warning('Could not preprocess frame, keeping it as received: %s', error)
+            return frame
+        return output.getvalue()
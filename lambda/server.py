@@ -0,0 +1,209 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Serves the challenge API from a long-running process (e.g. containers behind a load balancer), with the same
+# routes as the API Gateway deployment. Connections are handled by an asyncio event loop, while requests run
+# in a bounded thread pool, sharing the process' AWS clients (and their connection pools), detection pool,
+# detection cache, challenge cache and token secret. Requests beyond the pool and its queue are rejected with 503,
+# so an overloaded process sheds load instead of queueing it without bounds.
+#
+# Usage:
+#   python server.py --port 8080 --max-concurrent-requests 64 --max-pending-requests 256
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import signal
+
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import urlsplit
+
+CHALLENGE_PATH_PATTERN = re.compile('/challenge/([A-Za-z0-9-]+)/')
+HEALTH_PATH = '/health'
+BINARY_MEDIA_TYPE = 'application/octet-stream'
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': '*',
+    # The wildcard does not cover Authorization, which batch uploads send
+    'Access-Control-Allow-Headers': 'Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token'
+}
+
+logger = logging.getLogger()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves the challenge API over HTTP')
+    parser.add_argument('--host', default=os.getenv('SERVER_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('SERVER_PORT', '8080')))
+    parser.add_argument('--max-concurrent-requests', type=int,
+                        default=int(os.getenv('MAX_CONCURRENT_REQUESTS', '64')),
+                        help='requests processed at once (threads of the request pool)')
+    parser.add_argument('--max-pending-requests', type=int, default=int(os.getenv('MAX_PENDING_REQUESTS', '256')),
+                        help='requests waiting for the request pool, beyond which requests are rejected')
+    parser.add_argument('--max-body-bytes', type=int, default=int(os.getenv('MAX_BODY_BYTES', str(10 * 2 ** 20))))
+    parser.add_argument('--keep-alive-seconds', type=float, default=float(os.getenv('KEEP_ALIVE_SECONDS', '75')),
+                        help='idle time before a client connection is closed (above the load balancer\'s)')
+    args = parser.parse_args()
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'))
+    # Every request thread may use a connection to each service at once
+    os.environ.setdefault('MAX_POOL_CONNECTIONS', str(args.max_concurrent_requests))
+    asyncio.run(serve(args))
+
+
+async def serve(args):
+    # Imported once the connection pools are configured
+    import app
+    server = Server(app.lambda_handler, args.max_concurrent_requests, args.max_pending_requests,
+                    args.max_body_bytes, args.keep_alive_seconds)
+    listener = await asyncio.start_server(server.handle_connection, args.host, args.port)
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stopped.set)
+    logger.info('Listening on %s:%d', args.host, args.port)
+    async with listener:
+        await stopped.wait()
+    # Stops accepting connections, then lets the requests in progress complete
+    logger.info('Stopping')
+    await server.drain()
+
+
+class Server:
+
+    def __init__(self, handler, max_concurrent_requests, max_pending_requests, max_body_bytes, keep_alive_seconds):
+        self.handler = handler
+        self.max_requests = max_concurrent_requests + max_pending_requests
+        self.max_body_bytes = max_body_bytes
+        self.keep_alive_seconds = keep_alive_seconds
+        self.request_pool = ThreadPoolExecutor(max_workers=max_concurrent_requests)
+        # Requests in the request pool, running or queued
+        self.requests = 0
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while await self.handle_next_request(reader, writer):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    # Returns whether the connection can be kept open
+    async def handle_next_request(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), self.keep_alive_seconds)
+        except asyncio.TimeoutError:
+            return False
+        if not request_line:
+            return False
+        try:
+            method, target, version = request_line.decode('latin-1').split()
+            headers = await read_headers(reader)
+            content_length = int(headers.get('content-length', '0'))
+        except ValueError:
+            # Malformed request line or headers, or a line above the stream limit
+            await write_response(writer, 400, {}, {'message': 'Bad request'}, False)
+            return False
+        keep_alive = get_keep_alive(version, headers)
+        if 'transfer-encoding' in headers:
+            await write_response(writer, 411, {}, {'message': 'Content-Length required'}, False)
+            return False
+        if content_length < 0 or content_length > self.max_body_bytes:
+            await write_response(writer, 413, {}, {'message': 'Request body too large'}, False)
+            return False
+        body = await reader.readexactly(content_length)
+        status_code, response_headers, response = await self.handle_request(method, target, headers, body)
+        await write_response(writer, status_code, response_headers, response, keep_alive)
+        return keep_alive
+
+    async def handle_request(self, method, target, headers, body):
+        path = urlsplit(target).path
+        if method == 'GET' and path == HEALTH_PATH:
+            return 200, {}, {'requests': self.requests}
+        if method == 'OPTIONS':
+            return 204, CORS_HEADERS, None
+        if self.requests >= self.max_requests:
+            return 503, {'Retry-After': '1'}, {'message': 'Too many requests'}
+        event = get_event(method, path, headers, body)
+        if event is None:
+            return 400, {}, {'message': 'Invalid request body'}
+        self.requests += 1
+        try:
+            loop = asyncio.get_running_loop()
+            response = await loop.run_in_executor(self.request_pool, self.handler, event, None)
+        except Exception:
+            logger.exception('Could not handle request %s %s', method, path)
+            return 500, {}, {'message': 'Internal server error'}
+        finally:
+            self.requests -= 1
+        return response['statusCode'], response['headers'], response['body']
+
+    async def drain(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.request_pool.shutdown)
+
+
+async def read_headers(reader):
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            return headers
+        name, separator, value = line.decode('latin-1').partition(':')
+        if not separator:
+            raise ValueError('Malformed header')
+        headers[name.strip().lower()] = value.strip()
+
+
+def get_keep_alive(version, headers):
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.0':
+        return connection == 'keep-alive'
+    return connection != 'close'
+
+
+# Builds the API Gateway (REST API proxy integration) event of the request
+def get_event(method, path, headers, body):
+    match = CHALLENGE_PATH_PATTERN.match(path)
+    event = {
+        'httpMethod': method,
+        'path': path,
+        'pathParameters': {'challengeId': match.group(1)} if match else None,
+        'headers': headers,
+        'isBase64Encoded': False
+    }
+    # Binary bodies are passed as Latin-1 strings, which map each byte to a character
+    if headers.get('content-type', '').split(';')[0].strip() == BINARY_MEDIA_TYPE:
+        event['body'] = body.decode('latin-1')
+        return event
+    try:
+        event['body'] = body.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+    return event
+
+
+async def write_response(writer, status_code, headers, body, keep_alive):
+    if body is None:
+        payload = b''
+    elif isinstance(body, str):
+        payload = body.encode('utf-8')
+    else:
+        payload = json.dumps(body).encode('utf-8')
+    lines = ['HTTP/1.1 {} {}'.format(status_code, HTTPStatus(status_code).phrase)]
+    lines.extend('{}: {}'.format(name, value) for name, value in headers.items())
+    if payload:
+        lines.append('Content-Type: application/json')
+    lines.append('Content-Length: {}'.format(len(payload)))
+    lines.append('Connection: {}'.format('keep-alive' if keep_alive else 'close'))
+    writer.write('\r\n'.join(lines).encode('latin-1') + b'\r\n\r\n' + payload)
+    # Waits while the client does not read, so slow clients do not pile up responses in memory
+    await writer.drain()
+
+
+if __name__ == '__main__':
+    main()
@@ -22,12 +22,9 @@ class AreaState:
 
     def process(self, frame):
         self.frame = frame
-        face_bounding_box = [
-            self.image_width * frame['rekMetadata'][0]['BoundingBox']['Left'],
-            self.image_height * frame['rekMetadata'][0]['BoundingBox']['Top'],
-            self.image_width * frame['rekMetadata'][0]['BoundingBox']['Width'],
-            self.image_height * frame['rekMetadata'][0]['BoundingBox']['Height']
-        ]
+        if not frame.face_count:
+            return None
+        face_bounding_box = frame.get_bounding_box(self.image_width, self.image_height)
         inside_area_box = AreaState.is_inside_area_box(self.area_box, face_bounding_box)
         min_face_area = AreaState.is_min_face_area_percent(self.area_box, face_bounding_box, self.min_face_area_percent)
         success = (inside_area_box and min_face_area)
@@ -39,6 +36,13 @@ class AreaState:
     def get_next_state_success(self):
         return states.nose.NoseState(self.challenge, self.frame)
 
+    def get_snapshot(self):
+        return {}
+
+    @staticmethod
+    def from_snapshot(challenge, _):
+        return AreaState(challenge)
+
     @staticmethod
     def is_inside_area_box(face_area_box, face_box):
         return (face_area_box[0] <= face_box[0] and
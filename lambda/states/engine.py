@@ -0,0 +1,213 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import math
+
+import states.face  # must be imported before the other states
+
+from challenge import Challenge
+from observation import FaceObservation
+from states.area import AreaState
+from states.fail import FailState
+from states.nose import NoseState, QuadraticFit
+from states.success import SuccessState
+
+# Table-driven equivalent of StateManager and the state classes: states are integer codes, transitions are table
+# lookups and the challenge geometry is computed once (ChallengeRules), so processing a frame creates no state
+# objects. Decisions and snapshots are the same as StateManager's (tools/state_engine_diff.py checks it).
+
+FACE, AREA, NOSE, SUCCESS, FAIL = range(5)
+STATE_NAMES = ('FaceState', 'AreaState', 'NoseState', 'SuccessState', 'FailState')
+STATE_CODES = {name: code for code, name in enumerate(STATE_NAMES)}
+# Codes from SUCCESS onwards are final
+FIRST_FINAL_STATE = SUCCESS
+
+NEXT_ON_SUCCESS = (AREA, NOSE, SUCCESS, None, None)
+NEXT_ON_FAILURE = (None, FACE, FAIL, None, None)
+
+
+# Everything the states derive from the challenge, and the thresholds of the state classes (read when the rules
+# are built, so that values changed on the classes, e.g. by tools/rescore.py, apply)
+class ChallengeRules:
+
+    def __init__(self, challenge):
+        self.challenge = challenge
+        self.image_width = challenge['imageWidth']
+        self.image_height = challenge['imageHeight']
+        # Indexed by state code
+        self.durations = tuple(state_class.MAXIMUM_DURATION_IN_SECONDS for state_class in (
+            states.face.FaceState, AreaState, NoseState, SuccessState, FailState))
+        # AreaState
+        self.area_box = (challenge['areaLeft'], challenge['areaTop'], challenge['areaWidth'], challenge['areaHeight'])
+        self.min_face_area_percent = challenge['minFaceAreaPercent']
+        self.min_face_area_percent_tolerance = Challenge.MIN_FACE_AREA_PERCENT_TOLERANCE
+        # NoseState
+        area_width_tolerance = challenge['areaWidth'] * NoseState.AREA_BOX_TOLERANCE
+        area_height_tolerance = challenge['areaHeight'] * NoseState.AREA_BOX_TOLERANCE
+        self.nose_area_box = (challenge['areaLeft'] - area_width_tolerance,
+                              challenge['areaTop'] - area_height_tolerance,
+                              challenge['areaWidth'] + 2*area_width_tolerance,
+                              challenge['areaHeight'] + 2*area_height_tolerance)
+        nose_width_tolerance = challenge['noseWidth'] * NoseState.NOSE_BOX_TOLERANCE
+        nose_height_tolerance = challenge['noseHeight'] * NoseState.NOSE_BOX_TOLERANCE
+        self.nose_box = (challenge['noseLeft'] - nose_width_tolerance,
+                         challenge['noseTop'] - nose_height_tolerance,
+                         challenge['noseWidth'] + 2*nose_width_tolerance,
+                         challenge['noseHeight'] + 2*nose_height_tolerance)
+        self.challenge_in_the_right = challenge['noseLeft'] + Challenge.NOSE_BOX_SIZE/2 > self.image_width/2
+        self.histogram_bins = NoseState.HISTOGRAM_BINS
+        self.trajectory_error_threshold = NoseState.TRAJECTORY_ERROR_THRESHOLD
+        self.rotation_threshold = NoseState.ROTATION_THRESHOLD
+        self.min_dist_rotated = NoseState.MIN_DIST * NoseState.MIN_DIST_FACTOR_ROTATED
+        self.min_dist_not_rotated = NoseState.MIN_DIST * NoseState.MIN_DIST_FACTOR_NOT_ROTATED
+
+
+class StateEngine:
+
+    __slots__ = ('rules', 'state', 'end_time', 'original_frame', 'original_histogram', 'nose_trajectory',
+                 'trajectory_fit')
+
+    # Accepts the challenge or rules already built for it (e.g. shared by the engines of a replay)
+    def __init__(self, challenge):
+        self.rules = challenge if isinstance(challenge, ChallengeRules) else ChallengeRules(challenge)
+        self.state = FACE
+        self.end_time = None
+        self.original_frame = None
+        self.original_histogram = None
+        self.nose_trajectory = None
+        self.trajectory_fit = None
+
+    def process(self, frame):
+        frame_timestamp = frame.timestamp
+        if self.end_time and frame_timestamp > self.end_time:
+            self.state = FAIL
+            return
+        processor = PROCESSORS[self.state]
+        if processor is None:
+            return
+        success = processor(self, frame)
+        if success is not None:
+            if success:
+                self.change_state(NEXT_ON_SUCCESS[self.state], frame_timestamp, frame)
+            else:
+                self.change_state(NEXT_ON_FAILURE[self.state], frame_timestamp, frame)
+
+    def change_state(self, state, frame_timestamp, frame):
+        self.state = state
+        if state == NOSE:
+            self.start_nose(frame)
+        if frame_timestamp:
+            duration = self.rules.durations[state]
+            self.end_time = frame_timestamp + duration * 1000 if duration else None
+
+    def process_face(self, frame):
+        return True if frame.face_count == 1 else None
+
+    def process_area(self, frame):
+        if not frame.face_count:
+            return None
+        rules = self.rules
+        left, top, width, height = frame.bounding_box
+        face_left = rules.image_width * left
+        face_top = rules.image_height * top
+        face_width = rules.image_width * width
+        face_height = rules.image_height * height
+        area_left, area_top, area_width, area_height = rules.area_box
+        if not (area_left <= face_left and area_top <= face_top and
+                area_left + area_width >= face_left + face_width and
+                area_top + area_height >= face_top + face_height):
+            return None
+        face_area_percent = face_width * face_height * 100 / (area_width * area_height)
+        if face_area_percent + rules.min_face_area_percent_tolerance >= rules.min_face_area_percent:
+            return True
+        return None
+
+    def process_nose(self, frame):
+        if not frame.face_count:
+            return None
+        rules = self.rules
+        left, top, width, height = frame.bounding_box
+        face_left = rules.image_width * left
+        face_top = rules.image_height * top
+        area_left, area_top, area_width, area_height = rules.nose_area_box
+        if not (area_left <= face_left and area_top <= face_top and
+                area_left + area_width >= face_left + rules.image_width * width and
+                area_top + area_height >= face_top + rules.image_height * height):
+            return False
+        nose = frame.get_landmark('nose')
+        if nose is None:
+            return None
+        self.add_to_nose_trajectory(nose[0], nose[1])
+        nose_left = rules.image_width * nose[0]
+        nose_top = rules.image_height * nose[1]
+        box_left, box_top, box_width, box_height = rules.nose_box
+        if box_left <= nose_left <= box_left + box_width and box_top <= nose_top <= box_top + box_height:
+            return self.verify_nose(frame)
+        return None
+
+    def start_nose(self, original_frame):
+        self.original_frame = original_frame
+        self.original_histogram = self.get_landmarks_histogram(original_frame.landmarks)
+        self.nose_trajectory = []
+        self.trajectory_fit = QuadraticFit()
+
+    def add_to_nose_trajectory(self, x, y):
+        self.nose_trajectory.append((x, y))
+        self.trajectory_fit.add(x, y)
+
+    def verify_nose(self, frame):
+        import numpy as np
+        rules = self.rules
+        if not self.trajectory_fit.is_overdetermined():
+            return None
+        trajectory_error = math.sqrt(self.trajectory_fit.get_residuals() / len(self.nose_trajectory))
+        if trajectory_error > rules.trajectory_error_threshold:
+            return False
+        dist = np.linalg.norm(self.original_histogram - self.get_landmarks_histogram(frame.landmarks))
+        rotated_right = frame.yaw > rules.rotation_threshold
+        rotated_left = frame.yaw < - rules.rotation_threshold
+        if (rotated_right and rules.challenge_in_the_right) or (rotated_left and not rules.challenge_in_the_right):
+            min_dist = rules.min_dist_rotated
+        elif not (rotated_left or rotated_right):
+            min_dist = rules.min_dist_not_rotated
+        else:
+            return False
+        return dist > min_dist
+
+    def get_landmarks_histogram(self, landmarks):
+        points = landmarks * (self.rules.image_width, self.rules.image_height)
+        return NoseState.get_histogram(points, self.rules.histogram_bins)
+
+    def get_current_state_name(self):
+        return STATE_NAMES[self.state]
+
+    def is_final(self):
+        return self.state >= FIRST_FINAL_STATE
+
+    # Same snapshots as StateManager's, so either can resume from the other's
+    def get_snapshot(self):
+        if self.state == NOSE:
+            snapshot = {
+                'originalFrame': self.original_frame.to_snapshot(),
+                'noseTrajectory': [list(nose) for nose in self.nose_trajectory]
+            }
+        else:
+            snapshot = {}
+        snapshot['state'] = STATE_NAMES[self.state]
+        snapshot['endTime'] = self.end_time
+        return snapshot
+
+    @classmethod
+    def from_snapshot(cls, challenge, snapshot):
+        engine = cls(challenge)
+        engine.state = STATE_CODES[snapshot['state']]
+        if engine.state == NOSE:
+            engine.start_nose(FaceObservation.from_snapshot(snapshot['originalFrame']))
+            for x, y in snapshot['noseTrajectory']:
+                engine.add_to_nose_trajectory(x, y)
+        engine.end_time = snapshot['endTime']
+        return engine
+
+
+PROCESSORS = (StateEngine.process_face, StateEngine.process_area, StateEngine.process_nose, None, None)
+
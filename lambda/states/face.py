@@ -13,7 +13,7 @@ class FaceState:
 
     def process(self, frame):
         success = False
-        if len(frame['rekMetadata']) == 1:
+        if frame.face_count == 1:
             success = True
         return True if success else None
 
@@ -22,3 +22,10 @@ class FaceState:
 
     def get_next_state_success(self):
         return AreaState(self.challenge)
+
+    def get_snapshot(self):
+        return {}
+
+    @staticmethod
+    def from_snapshot(challenge, _):
+        return FaceState(challenge)
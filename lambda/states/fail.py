@@ -7,3 +7,10 @@ class FailState:
 
     def process(self, _):
         return None
+
+    def get_snapshot(self):
+        return {}
+
+    @staticmethod
+    def from_snapshot(_, __):
+        return FailState()
@@ -1,17 +1,23 @@
 # Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0
 
+import states.face
+import states.area
 import states.fail
+import states.nose
+import states.success
 
 
 class StateManager:
 
+    FINAL_STATES = {'SuccessState', 'FailState'}
+
     def __init__(self, first_state):
         self.end_time = None
         self.change_current_state(first_state)
 
     def process(self, frame):
-        frame_timestamp = frame['timestamp']
+        frame_timestamp = frame.timestamp
         if self.end_time and frame_timestamp > self.end_time:
             self.change_current_state(states.fail.FailState())
             return
@@ -35,3 +41,30 @@ class StateManager:
 
     def get_current_state_name(self):
         return type(self.current_state).__name__
+
+    def is_final(self):
+        return self.get_current_state_name() in StateManager.FINAL_STATES
+
+    # Captures everything needed to resume processing later (e.g. in another invocation)
+    def get_snapshot(self):
+        snapshot = self.current_state.get_snapshot()
+        snapshot['state'] = self.get_current_state_name()
+        snapshot['endTime'] = self.end_time
+        return snapshot
+
+    @classmethod
+    def from_snapshot(cls, challenge, snapshot):
+        state_class = StateManager.get_state_classes()[snapshot['state']]
+        state_manager = cls(state_class.from_snapshot(challenge, snapshot))
+        state_manager.end_time = snapshot['endTime']
+        return state_manager
+
+    @staticmethod
+    def get_state_classes():
+        return {state_class.__name__: state_class for state_class in (
+            states.face.FaceState,
+            states.area.AreaState,
+            states.nose.NoseState,
+            states.success.SuccessState,
+            states.fail.FailState
+        )}
@@ -3,14 +3,15 @@
 
 import math
 
-import numpy as np
-
 import states.area
 import states.face
 import states.fail
 import states.success
 
 from challenge import Challenge
+from observation import FaceObservation
+
+# NumPy is imported by the methods that use it, so that only requests running a NoseState pay for it on cold starts
 
 
 class NoseState:
@@ -45,38 +46,38 @@ class NoseState:
                          challenge['noseHeight'] + 2*nose_height_tolerance)
         self.challenge_in_the_right = challenge['noseLeft'] + Challenge.NOSE_BOX_SIZE/2 > self.image_width/2
         self.original_frame = original_frame
-        self.original_landmarks = original_frame['rekMetadata'][0]['Landmarks']
+        self.original_landmarks = original_frame.landmarks
+        # The first frame never changes, so its histogram is computed only once
+        self.original_histogram = self.get_landmarks_histogram(self.original_landmarks)
         self.nose_trajectory = []
+        self.trajectory_fit = QuadraticFit()
 
     def process(self, frame):
-        rek_metadata = frame['rekMetadata'][0]
-        rek_face_bbox = [
-            self.image_width * rek_metadata['BoundingBox']['Left'],
-            self.image_height * rek_metadata['BoundingBox']['Top'],
-            self.image_width * rek_metadata['BoundingBox']['Width'],
-            self.image_height * rek_metadata['BoundingBox']['Height']
-        ]
+        if not frame.face_count:
+            return None
+        rek_face_bbox = frame.get_bounding_box(self.image_width, self.image_height)
         if not states.area.AreaState.is_inside_area_box(self.area_box, rek_face_bbox):
             return False
 
-        rek_landmarks = rek_metadata['Landmarks']
-        rek_pose = rek_metadata['Pose']
-
-        if self.is_inside_nose_box(rek_landmarks):
-            verified = self.verify_challenge(rek_landmarks, rek_pose, self.challenge_in_the_right)
+        if self.is_inside_nose_box(frame):
+            verified = self.verify_challenge(frame.landmarks, frame.yaw, self.challenge_in_the_right)
             return verified
 
         return None
 
-    def is_inside_nose_box(self, landmarks):
-        for landmark in landmarks:
-            if landmark['Type'] == 'nose':
-                nose_left = self.image_width * landmark['X']
-                nose_top = self.image_height * landmark['Y']
-                self.nose_trajectory.append((landmark['X'], landmark['Y']))
-                return (self.nose_box[0] <= nose_left <= self.nose_box[0] + self.nose_box[2] and
-                        self.nose_box[1] <= nose_top <= self.nose_box[1] + self.nose_box[3])
-        return False
+    def is_inside_nose_box(self, frame):
+        nose = frame.get_landmark('nose')
+        if nose is None:
+            return False
+        nose_left = self.image_width * nose[0]
+        nose_top = self.image_height * nose[1]
+        self.add_to_nose_trajectory(nose[0], nose[1])
+        return (self.nose_box[0] <= nose_left <= self.nose_box[0] + self.nose_box[2] and
+                self.nose_box[1] <= nose_top <= self.nose_box[1] + self.nose_box[3])
+
+    def add_to_nose_trajectory(self, x, y):
+        self.nose_trajectory.append((x, y))
+        self.trajectory_fit.add(x, y)
 
     def get_next_state_failure(self):
         return states.fail.FailState()
@@ -84,33 +85,35 @@ class NoseState:
     def get_next_state_success(self):
         return states.success.SuccessState()
 
-    def verify_challenge(self, current_landmarks, pose, challenge_in_the_right):
-        # Validating continuous and linear nose trajectory
-        nose_trajectory_x = [nose[0] for nose in self.nose_trajectory]
-        nose_trajectory_y = [nose[1] for nose in self.nose_trajectory]
-        _, residuals, _, _, _ = np.polyfit(nose_trajectory_x, nose_trajectory_y, 2, full=True)
-        trajectory_error = math.sqrt(residuals/len(self.nose_trajectory))
+    def get_snapshot(self):
+        return {
+            'originalFrame': self.original_frame.to_snapshot(),
+            'noseTrajectory': [list(nose) for nose in self.nose_trajectory]
+        }
+
+    @staticmethod
+    def from_snapshot(challenge, snapshot):
+        original_frame = FaceObservation.from_snapshot(snapshot['originalFrame'])
+        state = NoseState(challenge, original_frame)
+        for x, y in snapshot['noseTrajectory']:
+            state.add_to_nose_trajectory(x, y)
+        return state
+
+    def verify_challenge(self, current_landmarks, yaw, challenge_in_the_right):
+        import numpy as np
+        # Validating continuous and linear nose trajectory (a quadratic passes through any three points, so a
+        # jump to the nose box is only told apart from a trajectory once more points are collected)
+        if not self.trajectory_fit.is_overdetermined():
+            return None
+        trajectory_error = math.sqrt(self.trajectory_fit.get_residuals() / len(self.nose_trajectory))
         if trajectory_error > NoseState.TRAJECTORY_ERROR_THRESHOLD:
             return False
 
-        # Plotting landmarks from the first frame in a histogram
-        original_landmarks_x = [self.image_width * landmark['X'] for landmark in self.original_landmarks]
-        original_landmarks_y = [self.image_height * landmark['Y'] for landmark in self.original_landmarks]
-        original_histogram, _, _ = np.histogram2d(original_landmarks_x,
-                                                  original_landmarks_y,
-                                                  bins=NoseState.HISTOGRAM_BINS)
-        original_histogram = np.reshape(original_histogram, NoseState.HISTOGRAM_BINS**2) / len(original_landmarks_x)
         # Plotting landmarks from the last frame in a histogram
-        current_landmarks_x = [self.image_width * landmark['X'] for landmark in current_landmarks]
-        current_landmarks_y = [self.image_height * landmark['Y'] for landmark in current_landmarks]
-        current_histogram, _, _ = np.histogram2d(current_landmarks_x,
-                                                 current_landmarks_y,
-                                                 bins=NoseState.HISTOGRAM_BINS)
-        current_histogram = np.reshape(current_histogram, NoseState.HISTOGRAM_BINS**2) / len(current_landmarks_x)
+        current_histogram = self.get_landmarks_histogram(current_landmarks)
         # Calculating the Euclidean distance between histograms
-        dist = np.linalg.norm(original_histogram - current_histogram)
+        dist = np.linalg.norm(self.original_histogram - current_histogram)
         # Estimating left and right rotation
-        yaw = pose['Yaw']
         rotated_right = yaw > NoseState.ROTATION_THRESHOLD
         rotated_left = yaw < - NoseState.ROTATION_THRESHOLD
         rotated_face = rotated_left or rotated_right
@@ -125,3 +128,75 @@ class NoseState:
         if dist > min_dist:
             return True
         return False
+
+    def get_landmarks_histogram(self, landmarks):
+        points = landmarks * (self.image_width, self.image_height)
+        return NoseState.get_histogram(points, NoseState.HISTOGRAM_BINS)
+
+    # Same result as a normalized, flattened np.histogram2d(x, y, bins) over the points' own range
+    @staticmethod
+    def get_histogram(points, bins):
+        import numpy as np
+        mins = points.min(axis=0)
+        spans = points.max(axis=0) - mins
+        # Like np.histogram2d, a zero-width range is widened to one unit around the value
+        mins = np.where(spans > 0, mins, mins - 0.5)
+        spans = np.where(spans > 0, spans, 1.0)
+        indexes = np.minimum((bins * (points - mins) / spans).astype(int), bins - 1)
+        counts = np.bincount(indexes[:, 0] * bins + indexes[:, 1], minlength=bins**2)
+        return counts / len(points)
+
+
+# Least squares fit of y = a*x^2 + b*x + c, kept up to date from running sums
+class QuadraticFit:
+
+    def __init__(self):
+        self.origin = None
+        # Sums of x^0..x^4, of y*x^0..y*x^2, and of y^2
+        self.x_sums = [0.0] * 5
+        self.xy_sums = [0.0] * 3
+        self.yy_sum = 0.0
+        # Range of the (shifted) x values, which scales the normal equations
+        self.x_min = 0.0
+        self.x_max = 0.0
+        # The first three distinct x values
+        self.distinct_x = []
+
+    def add(self, x, y):
+        # Shifting points to the first one keeps the sums well conditioned
+        if self.origin is None:
+            self.origin = (x, y)
+        x = x - self.origin[0]
+        y = y - self.origin[1]
+        self.x_min = min(self.x_min, x)
+        self.x_max = max(self.x_max, x)
+        if len(self.distinct_x) < 3 and x not in self.distinct_x:
+            self.distinct_x.append(x)
+        power = 1.0
+        for i in range(5):
+            self.x_sums[i] += power
+            if i < 3:
+                self.xy_sums[i] += power * y
+            power *= x
+        self.yy_sum += y * y
+
+    # Whether the points can deviate from the best fit: with fewer than four points, or fewer than three distinct
+    # x values, some quadratic passes through all of them (np.polyfit returns no residuals then)
+    def is_overdetermined(self):
+        return self.x_sums[0] >= 4 and len(self.distinct_x) >= 3
+
+    # Sum of squared residuals of the best fit (only meaningful when the fit is overdetermined)
+    def get_residuals(self):
+        import numpy as np
+        s = self.x_sums
+        normal_matrix = np.array([[s[4], s[3], s[2]],
+                                  [s[3], s[2], s[1]],
+                                  [s[2], s[1], s[0]]])
+        normal_vector = np.array([self.xy_sums[2], self.xy_sums[1], self.xy_sums[0]])
+        # Fitting against x divided by its spread: for small spreads, the unscaled matrix has entries of very
+        # different magnitudes and lstsq drops the quadratic term as if it were rounding noise
+        spread = self.x_max - self.x_min or 1.0
+        scale = 1.0 / np.array([spread * spread, spread, 1.0])
+        scaled_vector = scale * normal_vector
+        coefficients = np.linalg.lstsq(normal_matrix * np.outer(scale, scale), scaled_vector, rcond=None)[0]
+        return max(self.yy_sum - float(np.dot(coefficients, scaled_vector)), 0.0)
@@ -7,3 +7,10 @@ class SuccessState:
 
     def process(self, _):
         return None
+
+    def get_snapshot(self):
+        return {}
+
+    @staticmethod
+    def from_snapshot(_, __):
+        return SuccessState()
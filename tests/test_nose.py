@@ -0,0 +1,70 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import random
+
+import pytest
+
+import states.face
+import synthetic
+from challenge import Challenge
+from observation import FaceObservation
+from states.engine import StateEngine
+from states.manager import StateManager
+from states.nose import QuadraticFit
+
+TOKEN_SECRET = 'test-nose-state-' * 2
+
+
+def get_challenge(seed):
+    random.seed(seed)
+    return vars(Challenge('test', 640, 480, TOKEN_SECRET))
+
+
+def replay(challenge, session):
+    frames = [FaceObservation.from_face_details(timestamp, str(timestamp), face_details)
+              for timestamp, face_details in session]
+    state_manager = StateManager(states.face.FaceState(challenge))
+    engine = StateEngine(challenge)
+    for frame in frames:
+        state_manager.process(frame)
+        engine.process(frame)
+    assert engine.get_current_state_name() == state_manager.get_current_state_name()
+    return state_manager.get_current_state_name()
+
+
+# Frames until the face fills the area, then the nose centered twice (A, A) and at once on the nose box (B)
+def get_jump_session(challenge, frame_count=40):
+    session = synthetic.generate_session(challenge, frame_count, passing=True)
+    without_face = min(synthetic.FRAMES_WITHOUT_FACE, frame_count // 4)
+    nose_frames = min(synthetic.MAX_NOSE_FRAMES, (frame_count - without_face) // 2)
+    approach = session[:frame_count - nose_frames]
+    centered = approach[-1][1]
+    target = session[-1][1]
+    interval = session[1][0] - session[0][0]
+    timestamp = approach[-1][0]
+    jumps = [(timestamp + interval * (index + 1), face) for index, face in enumerate([centered, centered, target])]
+    return approach + jumps
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_smooth_trajectory_succeeds(seed):
+    challenge = get_challenge(seed)
+    assert replay(challenge, synthetic.generate_session(challenge, 40, passing=True)) == 'SuccessState'
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_jump_to_the_nose_box_does_not_succeed(seed):
+    challenge = get_challenge(seed)
+    assert replay(challenge, get_jump_session(challenge)) != 'SuccessState'
+
+
+def test_fit_needs_four_points_with_three_distinct_x():
+    fit = QuadraticFit()
+    for x, y in [(0.5, 0.5), (0.5, 0.5), (0.7, 0.3)]:
+        fit.add(x, y)
+    assert not fit.is_overdetermined()
+    fit.add(0.7, 0.3)
+    assert not fit.is_overdetermined()
+    fit.add(0.6, 0.45)
+    assert fit.is_overdetermined()
@@ -0,0 +1,95 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+import base64
+import json
+import os
+
+import pytest
+
+import synthetic
+
+moto = pytest.importorskip('moto')
+
+REGION_NAME = 'us-east-1'
+BUCKET_NAME = 'test-bucket'
+TABLE_NAME = 'test-table'
+TOKEN_SECRET = 'verify-challenges-test-secret-0123456789'
+
+
+@pytest.fixture(scope='module')
+def app():
+    environment = {
+        'REGION_NAME': REGION_NAME,
+        'AWS_DEFAULT_REGION': REGION_NAME,
+        'AWS_ACCESS_KEY_ID': 'test',
+        'AWS_SECRET_ACCESS_KEY': 'test',
+        'BUCKET_NAME': BUCKET_NAME,
+        'DDB_TABLE': TABLE_NAME,
+        'TOKEN_SECRET_ARN': 'arn:aws:secretsmanager:us-east-1:123456789012:secret:test',
+        'FACE_DETECTOR': 'local',
+        'METRICS_ENABLED': 'false'
+    }
+    saved = {name: os.environ.get(name) for name in environment}
+    os.environ.update(environment)
+    mock = moto.mock_aws()
+    mock.start()
+    import boto3
+    boto3.client('s3', region_name=REGION_NAME).create_bucket(Bucket=BUCKET_NAME)
+    boto3.client('dynamodb', region_name=REGION_NAME).create_table(
+        TableName=TABLE_NAME,
+        KeySchema=[{'AttributeName': 'id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'id', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    import app
+    import clients
+    clients.token_secret_cache.fetch = lambda: TOKEN_SECRET
+    yield app
+    app.result_write_pool.shutdown(wait=True)
+    mock.stop()
+    for name, value in saved.items():
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+
+
+def call(app, method, path, path_parameters, body):
+    event = {'httpMethod': method, 'path': path, 'pathParameters': path_parameters, 'body': json.dumps(body)}
+    response = app.lambda_handler(event, None)
+    return response['statusCode'], json.loads(response['body'])
+
+
+def start_session(app, passing):
+    _, challenge = call(app, 'POST', '/challenge/start', None,
+                        {'userId': 'test', 'imageWidth': 640, 'imageHeight': 480})
+    detector = app.face_detector.detector
+    for timestamp, face_details in synthetic.generate_session(challenge, 30, passing, seed=1):
+        detector.results['{}/{}.jpg'.format(challenge['id'], timestamp)] = face_details
+        body = {'token': challenge['token'], 'timestamp': timestamp,
+                'frameBase64': base64.b64encode(os.urandom(100)).decode()}
+        status_code, _ = call(app, 'PUT', '/challenge/{}/frames'.format(challenge['id']),
+                              {'challengeId': challenge['id']}, body)
+        assert status_code == 200
+    return challenge
+
+
+def test_malformed_entries_do_not_fail_the_batch(app):
+    challenge = start_session(app, True)
+    entries = ['abc', {'challengeId': challenge['id'], 'token': challenge['token']}, {'token': 'x'},
+               {'challengeId': 5, 'token': 'x'}, None]
+    status_code, response = call(app, 'POST', '/challenge/verify/batch', None, {'challenges': entries})
+    assert status_code == 200
+    results = response['results']
+    assert [result['statusCode'] for result in results] == [400, 200, 400, 400, 400]
+    assert results[1]['success'] is True
+    assert results[1]['challengeId'] == challenge['id']
+    assert results[3]['challengeId'] == 5
+
+
+def test_single_malformed_entry(app):
+    status_code, response = call(app, 'POST', '/challenge/verify/batch', None, {'challenges': ['abc']})
+    assert status_code == 200
+    assert response['results'] == [{'statusCode': 400, 'message': 'Missing challengeId or token',
+                                    'challengeId': None}]
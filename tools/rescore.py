@@ -0,0 +1,191 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Replays stored challenges (with their saved Rekognition results) through the state machine
+# for many threshold sets at once and reports how the decisions would change.
+#
+# Usage:
+#   python tools/rescore.py challenges.jsonl \
+#       --param NoseState.MIN_DIST=0.08,0.10,0.12 \
+#       --param Challenge.MIN_FACE_AREA_PERCENT_TOLERANCE=15,20
+#
+# With --state-engine table, challenges are replayed by the table-driven engine (states/engine.py).
+
+import argparse
+import decimal
+import gzip
+import itertools
+import json
+import os
+import sys
+
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+import states.face  # noqa: E402 (must be imported before the other states)
+from challenge import Challenge  # noqa: E402
+from items import read_item  # noqa: E402
+from observation import FaceObservation  # noqa: E402
+from states.engine import StateEngine  # noqa: E402
+from states.manager import StateManager  # noqa: E402
+from states.nose import NoseState  # noqa: E402
+
+TUNABLE_CLASSES = {
+    'Challenge': Challenge,
+    'NoseState': NoseState
+}
+
+param_sets = None
+state_engine = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Re-scores stored challenges for different thresholds')
+    parser.add_argument('files', nargs='+',
+                        help='JSONL exports of challenge items or DynamoDB export files (optionally gzipped)')
+    parser.add_argument('--param', action='append', default=[], metavar='CLASS.NAME=V1,V2,...',
+                        help='threshold values to sweep (the cartesian product of all params is evaluated)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--chunk-size', type=int, default=500, help='number of challenges sent to a worker at once')
+    parser.add_argument('--state-engine', choices=['classes', 'table'], default='classes',
+                        help='replays challenges with the state classes or the table-driven engine')
+    parser.add_argument('--output', help='writes the report as JSON to this file')
+    args = parser.parse_args()
+
+    sets = get_param_sets(args.param)
+    totals = [new_counters() for _ in sets]
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                             initargs=(sets, args.state_engine)) as pool:
+        chunks = iter_chunks(iter_challenges(args.files), args.chunk_size)
+        for chunk_counters in pool.map(rescore_chunk, chunks):
+            for total, counters in zip(totals, chunk_counters):
+                for name, value in counters.items():
+                    total[name] += value
+
+    report = [dict(params=params, **counters) for params, counters in zip(sets, totals)]
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+
+# The first set always holds the current values, so the others can be compared against it
+def get_param_sets(param_args):
+    names = []
+    values = []
+    for param_arg in param_args:
+        name, _, raw_values = param_arg.partition('=')
+        class_name, _, attribute = name.partition('.')
+        if class_name not in TUNABLE_CLASSES or not hasattr(TUNABLE_CLASSES[class_name], attribute):
+            raise SystemExit('Unknown parameter: {}'.format(name))
+        names.append(name)
+        values.append([float(value) for value in raw_values.split(',')])
+    current = {name: get_param(name) for name in names}
+    sets = [current]
+    for combination in itertools.product(*values):
+        params = dict(zip(names, combination))
+        if params != current:
+            sets.append(params)
+    return sets
+
+
+def get_param(name):
+    class_name, _, attribute = name.partition('.')
+    return getattr(TUNABLE_CLASSES[class_name], attribute)
+
+
+def set_param(name, value):
+    class_name, _, attribute = name.partition('.')
+    setattr(TUNABLE_CLASSES[class_name], attribute, value)
+
+
+def iter_challenges(files):
+    for file_name in files:
+        opener = gzip.open if file_name.endswith('.gz') else open
+        with opener(file_name, 'rt') as lines:
+            for line in lines:
+                if line.strip():
+                    yield read_challenge(json.loads(line, parse_float=decimal.Decimal))
+
+
+# Accepts both plain items and DynamoDB JSON ({"Item": {"id": {"S": ...}, ...}})
+def read_challenge(record):
+    if 'Item' in record and isinstance(record['Item'], dict):
+        from boto3.dynamodb.types import TypeDeserializer
+        deserializer = TypeDeserializer()
+        record = {key: deserializer.deserialize(value) for key, value in record['Item'].items()}
+    return read_item(record)
+
+
+def iter_chunks(iterable, size):
+    while True:
+        chunk = list(itertools.islice(iterable, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def init_worker(sets, engine):
+    global param_sets, state_engine
+    param_sets = sets
+    state_engine = engine
+
+
+def new_counters():
+    return {
+        'challenges': 0,
+        'successes': 0,
+        'changedFromCurrent': 0,
+        'changedFromStored': 0,
+        'partial': 0
+    }
+
+
+# Each challenge is decoded once and replayed for every parameter set
+def rescore_chunk(challenges):
+    counters = [new_counters() for _ in param_sets]
+    replays = []
+    for challenge in challenges:
+        frames = sorted((FaceObservation.from_item(frame) for frame in challenge.get('frames', [])),
+                        key=lambda frame: frame.timestamp)
+        replays.append((challenge, frames, [frame for frame in frames if frame.is_analyzed()]))
+    current_successes = None
+    for params, counter in zip(param_sets, counters):
+        for name, value in params.items():
+            set_param(name, value)
+        results = [replay(challenge, analyzed_frames) for challenge, _, analyzed_frames in replays]
+        if current_successes is None:
+            current_successes = results
+        for (challenge, frames, analyzed_frames), success, current_success in zip(replays, results, current_successes):
+            counter['challenges'] += 1
+            counter['successes'] += success
+            counter['changedFromCurrent'] += success != current_success
+            counter['changedFromStored'] += 'success' in challenge and success != challenge['success']
+            # Frames after the final state were never analyzed, so new thresholds may lack evidence
+            counter['partial'] += len(analyzed_frames) != len(frames)
+    return counters
+
+
+def replay(challenge, frames):
+    if state_engine == 'table':
+        state_manager = StateEngine(challenge)
+    else:
+        state_manager = StateManager(states.face.FaceState(challenge))
+    for frame in frames:
+        state_manager.process(frame)
+        if state_manager.is_final():
+            break
+    return state_manager.get_current_state_name() == 'SuccessState'
+
+
+def print_report(report):
+    for entry in report:
+        params = ', '.join('{}={}'.format(name, value) for name, value in entry['params'].items()) or 'current'
+        print('{}: {} challenges, {} successes, {} changed from current, {} changed from stored, {} partial'.format(
+            params, entry['challenges'], entry['successes'], entry['changedFromCurrent'],
+            entry['changedFromStored'], entry['partial']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Checks that the table-driven state engine (states/engine.py) makes the same decisions as the state classes
+# (states/manager.py). Every session is replayed through both, comparing the state and the snapshot after each
+# frame and resuming each one from the other's snapshots at random points. Sessions are read from challenge
+# exports (as for tools/rescore.py) and generated like the benchmark's, fuzzed with dropped frames, frames without
+# a face, with several faces or without the nose, jittered faces and timestamp gaps beyond the nose challenge
+# timeout. Exits with status 1 on any mismatch.
+#
+# Usage:
+#   python tools/state_engine_diff.py --synthetic 2000
+#   python tools/state_engine_diff.py challenges.jsonl --synthetic 0
+
+import argparse
+import copy
+import os
+import random
+import sys
+import time
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TOOLS_DIR, '..', 'benchmarks'))
+sys.path.insert(0, os.path.join(TOOLS_DIR, '..', 'lambda'))
+
+import states.face  # noqa: E402 (must be imported before the other states)
+import synthetic  # noqa: E402
+from challenge import Challenge  # noqa: E402
+from items import read_item, write_item  # noqa: E402
+from observation import FaceObservation  # noqa: E402
+from rescore import iter_challenges  # noqa: E402
+from states.engine import ChallengeRules, StateEngine  # noqa: E402
+from states.manager import StateManager  # noqa: E402
+from states.nose import NoseState  # noqa: E402
+
+IMAGE_SIZES = [(640, 480), (1280, 720), (480, 640)]
+FUZZ_KINDS = ['drop', 'no-face', 'multi-face', 'no-nose', 'jitter', 'gap']
+JITTER = 0.01
+MAX_GAP_EXCESS_MS = 5000
+# Only signs the tokens of the synthetic challenges
+TOKEN_SECRET = 'state-engine-diff-' * 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the table-driven state engine with the state classes')
+    parser.add_argument('files', nargs='*',
+                        help='JSONL exports of challenge items or DynamoDB export files (optionally gzipped)')
+    parser.add_argument('--synthetic', type=int, default=1000, help='number of synthetic sessions')
+    parser.add_argument('--max-frames', type=int, default=120, help='maximum frames of a synthetic session')
+    parser.add_argument('--fuzz-rate', type=float, default=0.1, help='share of synthetic frames altered')
+    parser.add_argument('--resume-points', type=int, default=3, help='snapshots resumed from in each session')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-reports', type=int, default=10, help='mismatches printed')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    # Nose boxes are drawn by Challenge from the global generator
+    random.seed(args.seed)
+    sessions = list(iter_exported_sessions(args.files))
+    sessions.extend(generate_sessions(args.synthetic, args.max_frames, args.fuzz_rate, rng))
+
+    mismatches = []
+    timings = {'classes': 0.0, 'table': 0.0}
+    decisions = {}
+    processed = 0
+    for name, challenge, frames in sessions:
+        for mismatch in compare_session(challenge, frames, args.resume_points, rng):
+            mismatches.append('{}: {}'.format(name, mismatch))
+        state_name, count = time_replays(challenge, frames, timings)
+        processed += count
+        decisions[state_name] = decisions.get(state_name, 0) + 1
+
+    frame_count = sum(len(frames) for _, _, frames in sessions)
+    print('{} sessions, {} frames, decisions: {}'.format(len(sessions), frame_count, ', '.join(
+        '{} {}'.format(count, name) for name, count in sorted(decisions.items()))))
+    for name, seconds in timings.items():
+        print('{:<12} {:>10.3f} s {:>8.2f} us/frame'.format(name, seconds, seconds * 1e6 / max(processed, 1)))
+    for mismatch in mismatches[:args.max_reports]:
+        print('MISMATCH {}'.format(mismatch))
+    print('{} mismatches'.format(len(mismatches)))
+    sys.exit(1 if mismatches else 0)
+
+
+def iter_exported_sessions(files):
+    for challenge in iter_challenges(files):
+        frames = sorted((FaceObservation.from_item(frame) for frame in challenge.get('frames', [])),
+                        key=lambda frame: frame.timestamp)
+        yield challenge.get('id'), challenge, [frame for frame in frames if frame.is_analyzed()]
+
+
+def generate_sessions(count, max_frames, fuzz_rate, rng):
+    sessions = []
+    for index in range(count):
+        image_width, image_height = rng.choice(IMAGE_SIZES)
+        challenge = vars(Challenge('diff', image_width, image_height, TOKEN_SECRET))
+        session = synthetic.generate_session(challenge, rng.randint(4, max_frames), rng.random() < 0.5,
+                                             seed=rng.random())
+        frames = [FaceObservation.from_face_details(timestamp, str(timestamp), face_details)
+                  for timestamp, face_details in fuzz(session, fuzz_rate, rng)]
+        sessions.append(('synthetic-{}'.format(index), challenge, frames))
+    return sessions
+
+
+def fuzz(session, rate, rng):
+    fuzzed = []
+    offset = 0
+    for timestamp, faces in session:
+        kind = rng.choice(FUZZ_KINDS) if rng.random() < rate else None
+        if kind == 'drop':
+            continue
+        if kind == 'gap':
+            offset += NoseState.MAXIMUM_DURATION_IN_SECONDS * 1000 + rng.randint(1, MAX_GAP_EXCESS_MS)
+        elif kind == 'no-face':
+            faces = []
+        elif faces and kind == 'multi-face':
+            faces = faces + [jitter(faces[0], rng, 0.2)]
+        elif faces and kind == 'no-nose':
+            face = copy.deepcopy(faces[0])
+            face['Landmarks'] = [landmark for landmark in face['Landmarks'] if landmark['Type'] != 'nose']
+            faces = [face] + faces[1:]
+        elif faces and kind == 'jitter':
+            faces = [jitter(faces[0], rng, JITTER)] + faces[1:]
+        fuzzed.append((timestamp + offset, faces))
+    return fuzzed
+
+
+def jitter(face, rng, scale):
+    face = copy.deepcopy(face)
+    for name in ('Left', 'Top'):
+        face['BoundingBox'][name] += rng.uniform(-scale, scale)
+    for landmark in face['Landmarks']:
+        landmark['X'] += rng.uniform(-scale, scale)
+        landmark['Y'] += rng.uniform(-scale, scale)
+    face['Pose']['Yaw'] += rng.uniform(-100, 100) * scale
+    return face
+
+
+def compare_session(challenge, frames, resume_points, rng):
+    manager = StateManager(states.face.FaceState(challenge))
+    engine = StateEngine(challenge)
+    snapshots = []
+    for index, frame in enumerate(frames):
+        manager.process(frame)
+        engine.process(frame)
+        mismatch = compare(manager, engine)
+        if mismatch:
+            return ['frame {}: {}'.format(index, mismatch)]
+        # As stored in the challenge item
+        snapshots.append(read_item(write_item(manager.get_snapshot())))
+    mismatches = []
+    # Resuming from a snapshot gives the same result as processing every frame, whichever wrote it
+    rules = ChallengeRules(challenge)
+    for index in sorted(rng.sample(range(len(snapshots)), min(resume_points, len(snapshots)))):
+        resumed_manager = StateManager.from_snapshot(challenge, snapshots[index])
+        resumed_engine = StateEngine.from_snapshot(rules, snapshots[index])
+        for frame in frames[index + 1:]:
+            resumed_manager.process(frame)
+            resumed_engine.process(frame)
+        mismatch = compare(resumed_manager, resumed_engine) or compare(manager, resumed_engine)
+        if mismatch:
+            mismatches.append('resumed after frame {}: {}'.format(index, mismatch))
+    return mismatches
+
+
+def compare(manager, engine):
+    if engine.get_current_state_name() != manager.get_current_state_name():
+        return 'state {} instead of {}'.format(engine.get_current_state_name(), manager.get_current_state_name())
+    if engine.is_final() != manager.is_final():
+        return 'is_final {} instead of {}'.format(engine.is_final(), manager.is_final())
+    if engine.get_snapshot() != manager.get_snapshot():
+        return 'snapshot {} instead of {}'.format(engine.get_snapshot(), manager.get_snapshot())
+    return None
+
+
+# Replays the session as verification does (until a final state), with each implementation.
+# Returns the final state and the number of frames processed.
+def time_replays(challenge, frames, timings):
+    start = time.perf_counter()
+    manager = StateManager(states.face.FaceState(challenge))
+    count = 0
+    for frame in frames:
+        count += 1
+        manager.process(frame)
+        if manager.is_final():
+            break
+    timings['classes'] += time.perf_counter() - start
+    start = time.perf_counter()
+    engine = StateEngine(challenge)
+    for frame in frames:
+        engine.process(frame)
+        if engine.is_final():
+            break
+    timings['table'] += time.perf_counter() - start
+    return manager.get_current_state_name(), count
+
+
+if __name__ == '__main__':
+    main()